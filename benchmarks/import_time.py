@@ -0,0 +1,63 @@
+'''
+
+Import-time benchmark for py-wsi. Imports the package in fresh interpreters and reports the
+median import time, and checks that none of the heavy backend dependencies were loaded by
+the import itself; they should only be imported on first use.
+
+Usage:
+    python benchmarks/import_time.py [--runs 5] [--budget 0.5]
+
+Exits with status 1 if a heavy module is imported eagerly or the median import time exceeds
+the budget in seconds.
+
+Author: @ysbecca
+
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Dependencies which must not be imported by "import py_wsi".
+HEAVY_MODULES = ['openslide', 'shapely', 'h5py', 'lmdb', 'PIL', 'xml.dom.minidom', 'matplotlib',
+                 'lz4', 'zstandard']
+
+SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import py_wsi
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": sorted(sys.modules)}))
+'''
+
+
+def time_import(repo_root):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repo_root + os.pathsep + env.get('PYTHONPATH', '')
+    output = subprocess.check_output([sys.executable, '-c', SNIPPET], env=env, cwd=repo_root)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="number of fresh interpreters to time")
+    parser.add_argument('--budget', type=float, default=0.5, help="maximum median import time in seconds")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [time_import(repo_root) for _ in range(args.runs)]
+    times = sorted(r['seconds'] for r in results)
+    median = times[len(times) // 2]
+
+    loaded = set(results[0]['modules'])
+    eager = [m for m in HEAVY_MODULES if m in loaded]
+
+    print("import py_wsi, median of", args.runs, "runs:", round(median * 1000, 1), "ms")
+    print("heavy modules imported eagerly:", eager if eager else "none")
+
+    if eager or median > args.budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
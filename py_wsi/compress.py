@@ -0,0 +1,93 @@
+'''
+
+Codecs for compressing patch pixels before they are stored. Each codec turns a uint8 patch into
+bytes and back again; all of them are lossless, so decoded patches are identical to the sampled ones.
+
+    - none      raw pixel bytes (fastest, largest)
+    - zlib      deflate from the standard library
+    - lz4       lz4 frame compression, if the lz4 package is installed
+    - zstd      Zstandard compression, if the zstandard package is installed
+    - png       lossless PNG via Pillow
+    - webp      lossless WebP via Pillow
+
+Author: @ysbecca
+
+'''
+import io
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .helpers import lazy_import, module_available
+
+# Imported on first use.
+Image = lazy_import('PIL.Image')
+lz4_frame = lazy_import('lz4.frame')
+zstandard = lazy_import('zstandard')
+
+
+CODECS = ['none', 'zlib', 'lz4', 'zstd', 'png', 'webp']
+
+
+def available_codecs():
+    ''' Returns the codecs which can be used with the packages installed. '''
+    codecs = ['none', 'zlib', 'png', 'webp']
+    if module_available('lz4'):
+        codecs.append('lz4')
+    if module_available('zstandard'):
+        codecs.append('zstd')
+    return codecs
+
+def check_codec(codec):
+    ''' Checks that a codec is known and its package is installed. '''
+    if codec not in CODECS:
+        print("[py-wsi error]: codec not recognised; expecting one of", CODECS)
+        return False
+    if codec not in available_codecs():
+        print("[py-wsi error]: codec", codec, "requires a package which is not installed.")
+        return False
+    return True
+
+def encode_patch(patch, codec='none'):
+    ''' Encodes a single uint8 patch into bytes with the given codec. '''
+    if codec == 'none':
+        return patch.tobytes()
+    elif codec == 'zlib':
+        return zlib.compress(patch.tobytes())
+    elif codec == 'lz4':
+        return lz4_frame.compress(patch.tobytes())
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(patch.tobytes())
+
+    # Image codecs.
+    buffer = io.BytesIO()
+    if codec == 'png':
+        Image.fromarray(patch).save(buffer, format='PNG')
+    else:
+        Image.fromarray(patch).save(buffer, format='WEBP', lossless=True)
+    return buffer.getvalue()
+
+def decode_patch(data, codec, shape):
+    ''' Decodes bytes written by encode_patch back into a uint8 patch of the given shape. '''
+    if codec in ['png', 'webp']:
+        return np.array(Image.open(io.BytesIO(data)), dtype=np.uint8).reshape(shape)
+
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'lz4':
+        data = lz4_frame.decompress(data)
+    elif codec == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    # Copy so that callers get a writable array, as they did before codecs existed.
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape).copy()
+
+def encode_patches(patches, codec='none', workers=None):
+    ''' Encodes a list of patches in parallel. zlib, lz4, zstd and Pillow all release the GIL
+        while compressing, so a thread pool scales with the number of cores.
+        - workers       number of encoding threads; None lets the pool decide
+    '''
+    if codec == 'none' or len(patches) <= 1:
+        return [encode_patch(p, codec) for p in patches]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(encode_patch, patches, [codec] * len(patches)))
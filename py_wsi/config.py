@@ -7,4 +7,35 @@ Author @ysbecca
 
 
 
-STORAGE_TYPES 			= ['lmdb', 'hdf5', 'disk']
+STORAGE_TYPES 			= ['lmdb', 'hdf5', 'disk', 'shards', 'npy']
+
+# Maximum size of a single tar shard for the 'shards' storage type.
+SHARD_MAX_BYTES 		= 1024 * 1024 * 1024
+
+# Where random patch locations may be drawn from.
+RANDOM_MASKS 			= ['none', 'tissue', 'annotation']
+
+# Bytes of sampled patches buffered before they are written in one transaction.
+TXN_BYTES 				= 512 * 1024 * 1024
+
+# Bytes of stored patches read at a time when building a mosaic.
+MOSAIC_BLOCK_BYTES 		= 64 * 1024 * 1024
+
+# Suffix of the file beside a store, named after db_name, which records how the store was sampled.
+STORE_INFO_SUFFIX 		= '_info.json'
+
+# Name of the file in db_location caching the slide properties read by a survey.
+SURVEY_CACHE_NAME 		= 'py_wsi_survey.json'
+
+# Whether read-only LMDB environments read ahead. Off, since stores larger than RAM are read a
+# slide's key range or a query at a time, where readahead only evicts pages still in use.
+LMDB_READAHEAD 			= False
+
+# Whether read-only LMDB environments use LMDB's lock table. Turn it off only for stores nobody
+# writes while they are read, e.g. on read-only filesystems; without it a concurrent writer may
+# reuse pages still being read. Spare read transactions are only kept without it.
+LMDB_LOCK 				= True
+
+# Read transactions each read-only LMDB environment without the lock table keeps for reuse, about
+# one per loader thread.
+LMDB_SPARE_TXNS 		= 16
@@ -17,7 +17,8 @@ class DataSet(object):
 
     def __init__(self, images, labels, image_cls, coords):
 
-        self._num_images = np.array(images).shape[0]
+        # len() rather than np.array() so that memory-mapped patches are not read into memory.
+        self._num_images = len(images)
         self._images = images
 
         # Boolean array versions of ID
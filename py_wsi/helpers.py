@@ -6,10 +6,40 @@ Author: @ysbecca
 
 '''
 
+import importlib
+import importlib.util
 import time
 from datetime import timedelta
 
 
+class LazyModule(object):
+
+    def __init__(self, name):
+        """ Stands in for a module which is only imported when one of its attributes is first used,
+            so that importing py_wsi does not pay for (or require) backends that are never used.
+            A missing package raises ImportError at that point rather than at import time.
+            - name          full module name, e.g. 'openslide.deepzoom'
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes which are not set on the proxy itself.
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module '" + self._name + "'>"
+
+def lazy_import(name):
+    return LazyModule(name)
+
+def module_available(name):
+    ''' Checks whether a top-level package is installed without importing it. '''
+    return importlib.util.find_spec(name) is not None
+
+
 # Helper timing functions.
 def start_timer():
     return time.time()
@@ -8,26 +8,67 @@ Author: @ysbecca
 
 import pickle
 import numpy as np
-from PIL import Image
 
-class Item(object):
+from .compress import encode_patch, decode_patch
+from .helpers import lazy_import
 
-    def __init__(self, patch, coords, label):
+Image = lazy_import('PIL.Image')
 
-        self.channels = patch.shape[2]
-        # Assuming only square images.
-        self.size = patch.shape[0]
-        self.data = patch.tobytes()
+class Item(object):
+
+    def __init__(self, patch, coords, label, ref=None, codec='none', data=None, shape=None, tiles=None):
+        """ - ref       key of a shared payload item holding the pixels, if the patch was deduplicated
+            - codec     codec the pixel data is encoded with (see compress.py)
+            - data      the already encoded pixels, if encoding was done beforehand
+            - shape     shape of the patch, if patch is None and only its encoded data is given
+            - tiles     (tile_size, overlap), if the pixels are assembled from the core tiles of the
+                        slide on read instead of being stored with the item
+        """
+        if patch is not None:
+            shape = patch.shape
+        self.channels = shape[2]
+        self.size = shape[0]
+        # Core tiles at the edges of a slide need not be square.
+        self.shape = tuple(shape)
         self.label = label # Integer label ie, 2 = Carcinoma in situ
         self.coords = coords
+        self.ref = ref
+        self.codec = codec
+        self.tiles = tiles
+        if ref or tiles:
+            self.data = b''
+        elif data is not None:
+            self.data = data
+        else:
+            self.data = encode_patch(patch, codec)
+
+    def resolve(self, payload):
+        """ Takes the pixels from the shared payload item this item refers to.
+        """
+        self.data = payload.data
+        self.codec = getattr(payload, 'codec', 'none')
+        self.ref = None
+
+    def assemble(self, patch):
+        """ Takes the pixels of a patch assembled from core tiles.
+        """
+        self.data = patch.tobytes()
+        self.codec = 'none'
+        self.tiles = None
 
     def get_label_array(self, num_classes):
         l = np.zeros((num_classes))
         l[self.label] = 1
         return l
 
+    def get_shape(self):
+        # Items written before non-square shapes existed are square.
+        return getattr(self, 'shape', (self.size, self.size, self.channels))
+
     def get_patch(self):
-        return np.fromstring(self.data, dtype=np.uint8).reshape(self.size, self.size, self.channels)
+        # Items written before codecs existed hold raw pixels and have no codec attribute.
+        codec = getattr(self, 'codec', 'none')
+        return decode_patch(self.data, codec, self.get_shape())
 
     def get_patch_as_image(self):
         return Image.fromarray(self.get_patch(), 'RGB')
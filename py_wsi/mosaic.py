@@ -0,0 +1,168 @@
+'''
+
+Stitches the stored patches of a slide back into a downsampled mosaic for quality control,
+optionally with the patch classes overlaid in colour.
+
+Author: @ysbecca
+
+'''
+
+import numpy as np
+
+
+# Overlay colours for class labels 0, 1, 2, ...; repeated if there are more classes.
+LABEL_COLOURS = np.array([
+    [31, 119, 180],
+    [255, 127, 14],
+    [44, 160, 44],
+    [214, 39, 40],
+    [148, 103, 189],
+    [140, 86, 75],
+    [227, 119, 194],
+    [127, 127, 127],
+    [188, 189, 34],
+    [23, 190, 207],
+], dtype=np.float32)
+
+
+def downsample_patches(patches, factor):
+    ''' Downsamples a stack of uint8 patches (N, H, W, C) by an integer factor, averaging each
+        factor x factor block. H and W must be divisible by factor. The blocks are summed as
+        integers, so that only the downsampled patches are ever converted to float.
+    '''
+    n, h, w, c = patches.shape
+    blocks = patches.reshape(n, h // factor, factor, w // factor, factor, c)
+    return blocks.sum(axis=(2, 4), dtype=np.uint32).astype(np.float32) / (factor * factor)
+
+def downsample_tiles(patches, offset, small, scale, classes=None, alpha=0.4):
+    ''' Crops small * scale pixels from offset in each patch, downsamples them by scale, and overlays
+        the classes in colour, if given. Returns float tiles (N, small, small, 3).
+    '''
+    end = offset + small * scale
+    if isinstance(patches, np.ndarray):
+        chunk = patches[:, offset:end, offset:end, :3]
+    else:
+        # Crop each patch before stacking, so that no uncropped copy of the patches is made.
+        chunk = np.stack([np.asarray(patch)[offset:end, offset:end, :3] for patch in patches])
+    tiles = downsample_patches(np.asarray(chunk, dtype=np.uint8), scale)
+
+    if classes is not None:
+        labelled = classes >= 0
+        colours = LABEL_COLOURS[classes[labelled] % len(LABEL_COLOURS)]
+        tiles[labelled] = (1 - alpha) * tiles[labelled] + alpha * colours[:, None, None, :]
+    return tiles
+
+def scaled_size(size, scale):
+    ''' Returns the size of a tile or patch in a mosaic of the given scale, or None if the scale is
+        larger than the size.
+    '''
+    if size // scale == 0:
+        print("[py-wsi error]: the mosaic scale", scale, "is larger than the tile or patch size", size)
+        return None
+    return size // scale
+
+class MosaicCanvas(object):
+
+    def __init__(self, coords, size, overlap=0, scale=8, pixel_coords=False, alpha=0.4, chunk_size=256):
+        """ A white canvas for the mosaic of the patches at the given coords, which are drawn onto it
+            with add() in blocks of any size and order, so that the patches of a slide never need to
+            be in memory at once.
+            - coords            x, y coords of all the patches, which set the size of the canvas
+            - size              tile size (patch size minus twice the overlap) for tile grid coords,
+                                or patch size for pixel coords; at least scale
+            - overlap           pixel overlap the patches were sampled with, cropped from tiles
+            - scale             integer downsampling factor. If it does not divide the tile size, each
+                                tile is cropped to a multiple of it, leaving out up to scale - 1 pixels
+                                at its right and bottom.
+            - pixel_coords      coords are the pixel coords of each patch's top left at the level, as
+                                stored by random sampling, rather than tile grid coords. Patches are
+                                placed at their coords divided by scale and overlap is ignored; where
+                                they overlap, later ones are drawn over earlier ones.
+            - alpha             opacity of the class overlay
+            - chunk_size        number of patches downsampled at once, which bounds memory use
+        """
+        self.small = size // scale
+        self.overlap = 0 if pixel_coords else overlap
+        self.scale = scale
+        self.pixel_coords = pixel_coords
+        self.alpha = alpha
+        self.chunk_size = chunk_size
+
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        if len(coords) == 0:
+            height, width = (1, 1) if pixel_coords else (self.small, self.small)
+        elif pixel_coords:
+            corners = coords // scale
+            height, width = corners[:, 1].max() + self.small, corners[:, 0].max() + self.small
+        else:
+            height, width = (coords[:, 1].max() + 1) * self.small, (coords[:, 0].max() + 1) * self.small
+        self.canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    def add(self, patches, coords, classes=None):
+        """ Downsamples patches and draws them at their coords.
+            - patches           sequence of patches (list, array or memmap) of equal size
+            - coords            x, y coords of each patch, among those the canvas was made for
+            - classes           optional class of each patch, overlaid in colour; -1 is not overlaid
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        if classes is not None:
+            classes = np.asarray(classes, dtype=np.int64)
+
+        small = self.small
+        if not self.pixel_coords:
+            # A view of the canvas indexed by [tile y, tile x, row, column, channel].
+            y_tiles, x_tiles = self.canvas.shape[0] // small, self.canvas.shape[1] // small
+            grid = self.canvas.reshape(y_tiles, small, x_tiles, small, 3).transpose(0, 2, 1, 3, 4)
+
+        for start in range(0, len(coords), self.chunk_size):
+            end = min(start + self.chunk_size, len(coords))
+            tiles = downsample_tiles(patches[start:end], self.overlap, small, self.scale,
+                                     classes[start:end] if classes is not None else None, self.alpha)
+            tiles = np.round(tiles).astype(np.uint8)
+            if self.pixel_coords:
+                for (x, y), tile in zip(coords[start:end] // self.scale, tiles):
+                    self.canvas[y:y + small, x:x + small] = tile
+            else:
+                grid[coords[start:end, 1], coords[start:end, 0]] = tiles
+
+def build_mosaic(patches,
+                 coords,
+                 tile_size,
+                 overlap=0,
+                 scale=8,
+                 classes=None,
+                 alpha=0.4,
+                 chunk_size=256):
+    ''' Builds a mosaic from patches and their tile grid coords. The overlap border of each patch is
+        cropped so that neighbouring tiles butt up against each other, then each tile is downsampled
+        by scale and written straight into a preallocated canvas.
+        - patches           sequence of patches (list, array or memmap) of equal size
+        - coords            x, y tile coords of each patch
+        - tile_size         patch size minus twice the overlap
+        - classes           optional class of each patch, overlaid in colour; -1 is not overlaid
+        - other parameters as for MosaicCanvas
+
+        Returns a uint8 RGB image; areas without patches are white.
+    '''
+    if scaled_size(tile_size, scale) is None:
+        return None
+    mosaic = MosaicCanvas(coords, tile_size, overlap=overlap, scale=scale, alpha=alpha, chunk_size=chunk_size)
+    mosaic.add(patches, coords, classes)
+    return mosaic.canvas
+
+def build_pixel_mosaic(patches, coords, scale=8, classes=None, alpha=0.4, chunk_size=256):
+    ''' Builds a mosaic from patches and their top left pixel coords at the level, as stored by random
+        sampling. Each patch is downsampled by scale, as by build_mosaic(), and placed at its coords
+        divided by scale; where patches overlap, later ones are drawn over earlier ones.
+        - patches           sequence of patches of equal size
+        - coords            x, y pixel coords of the top left of each patch
+        - other parameters as for build_mosaic()
+
+        Returns a uint8 RGB image; areas without patches are white.
+    '''
+    if len(patches) > 0 and scaled_size(np.shape(patches[0])[0], scale) is None:
+        return None
+    mosaic = MosaicCanvas(coords, np.shape(patches[0])[0] if len(patches) > 0 else scale, scale=scale,
+                          pixel_coords=True, alpha=alpha, chunk_size=chunk_size)
+    mosaic.add(patches, coords, classes)
+    return mosaic.canvas
@@ -6,14 +6,30 @@ sampling as is typically needed for deep learning.
 Author: @ysbecca
 '''
 
+import math
+import queue
+import threading
+import zlib
+
 import numpy as np
-from openslide import open_slide  
-from openslide.deepzoom import DeepZoomGenerator
-from glob import glob
-from xml.dom import minidom
-from shapely.geometry import Polygon, Point
 
 from .store import *
+from .stain import *
+from .helpers import lazy_import
+
+Image = lazy_import('PIL.Image')
+# OpenSlide, and Shapely and minidom for annotations, are imported on first use.
+openslide = lazy_import('openslide')
+deepzoom = lazy_import('openslide.deepzoom')
+geometry = lazy_import('shapely.geometry')
+prepared = lazy_import('shapely.prepared')
+minidom = lazy_import('xml.dom.minidom')
+
+def open_slide(filename):
+    return openslide.open_slide(filename)
+
+def DeepZoomGenerator(slide, tile_size=254, overlap=1, limit_bounds=False):
+    return deepzoom.DeepZoomGenerator(slide, tile_size=tile_size, overlap=overlap, limit_bounds=limit_bounds)
 
 def check_label_exists(label, label_map):
     ''' Checking if a label is a valid label. 
@@ -34,8 +50,8 @@ def generate_label(regions, region_labels, point, label_map):
         - label_map             the label dictionary mapping string labels to integer labels
     '''
     for i in range(len(region_labels)):
-        poly = Polygon(regions[i])
-        if poly.contains(Point(point[0], point[1])):
+        poly = geometry.Polygon(regions[i])
+        if poly.contains(geometry.Point(point[0], point[1])):
             if check_label_exists(region_labels[i], label_map):
                 return label_map[region_labels[i]]
             else:
@@ -74,6 +90,246 @@ def get_regions(path):
 def patch_to_tile_size(patch_size, overlap):
     return patch_size - overlap*2
 
+def get_patch_tile(tiles, level, x, y, patch_size):
+    ''' Reads the tile at grid coords x, y as a uint8 patch, or returns None for an edge tile.
+        OpenSlide calculates overlap in such a way that sometimes depending on the dimensions, edge
+        patches are smaller than the others. We will ignore such patches.
+    '''
+    new_tile = np.array(tiles.get_tile(level, (x, y)), dtype=np.uint8)
+    if np.shape(new_tile) == (patch_size, patch_size, 3):
+        return new_tile
+    return None
+
+def get_tile_core(tile, tiles, level, x, y, tile_size, overlap):
+    ''' Returns the core of a tile read from the DeepZoomGenerator at grid coords x, y: its pixels
+        without the overlap border, which are in no other tile's core. Tiles in the first row and
+        column have no border on their top and left, and cores at the right and bottom edges of the
+        level are smaller than tile_size.
+    '''
+    width, height = tiles.level_dimensions[level]
+    left, top = overlap * (x != 0), overlap * (y != 0)
+    # Copy, so that the rest of the tile is not kept in memory.
+    return tile[top:top + min(tile_size, height - tile_size * y),
+                left:left + min(tile_size, width - tile_size * x)].copy()
+
+def get_level_geometry(tiles, level):
+    ''' Returns the level 0 offset of a level's pixel grid (non-zero with limit_bounds) and the level's
+        downsample factor relative to level 0. Each level is half the resolution of the one above it.
+    '''
+    # Tile (0, 0) has no overlap on its top left, so its location is the grid offset.
+    offset = tiles.get_tile_coordinates(level, (0, 0))[0]
+    downsample = 2 ** (tiles.level_count - 1 - level)
+    return offset, downsample
+
+def get_roi_rows(tiles, level, tile_size, overlap, regions):
+    ''' Finds the tiles of a level which intersect any of the annotated regions. Each region's
+        bounding box is converted into the range of tile indices it covers, and only those tiles
+        are tested against the polygon itself.
+        - tiles                 the DeepZoomGenerator
+        - tile_size, overlap    as the DeepZoomGenerator was created with
+        - regions               array of region vertices in level 0 pixel coords, from get_regions()
+
+        Returns a dictionary mapping each tile row y to the sorted tile columns x to sample.
+    '''
+    x_tiles, y_tiles = tiles.level_tiles[level]
+    (offset_x, offset_y), downsample = get_level_geometry(tiles, level)
+    stride = tile_size * downsample
+
+    selected = set()
+    for region in regions:
+        if len(region) < 3:
+            continue
+        poly = geometry.Polygon(region)
+        if not poly.is_valid:
+            poly = poly.buffer(0)
+        prepared_poly = prepared.prep(poly)
+
+        # Tile index range of the bounding box, widened by one tile for the overlap border.
+        min_x, min_y, max_x, max_y = poly.bounds
+        x_start = max(int((min_x - offset_x) // stride) - 1, 0)
+        x_end = min(int((max_x - offset_x) // stride) + 1, x_tiles - 1)
+        y_start = max(int((min_y - offset_y) // stride) - 1, 0)
+        y_end = min(int((max_y - offset_y) // stride) + 1, y_tiles - 1)
+
+        for y in range(y_start, y_end + 1):
+            for x in range(x_start, x_end + 1):
+                if (x, y) in selected:
+                    continue
+                # The level 0 area covered by the patch, including its overlap border.
+                tile_box = geometry.box(offset_x + (x * tile_size - overlap) * downsample,
+                                        offset_y + (y * tile_size - overlap) * downsample,
+                                        offset_x + ((x + 1) * tile_size + overlap) * downsample,
+                                        offset_y + ((y + 1) * tile_size + overlap) * downsample)
+                if prepared_poly.intersects(tile_box):
+                    selected.add((x, y))
+
+    rows = {}
+    for x, y in sorted(selected):
+        rows.setdefault(y, []).append(x)
+    for y in rows:
+        rows[y].sort()
+    return rows
+
+def read_level_patch(slide, tiles, level, x, y, patch_size):
+    ''' Reads a patch whose top left corner is at pixel coords x, y of a level, directly through
+        OpenSlide from the best slide level, scaling as DeepZoomGenerator does.
+    '''
+    (offset_x, offset_y), downsample = get_level_geometry(tiles, level)
+    slide_level = slide.get_best_level_for_downsample(downsample)
+    read_size = int(math.ceil(patch_size * downsample / slide.level_downsamples[slide_level]))
+
+    region = slide.read_region((int(offset_x + x * downsample), int(offset_y + y * downsample)),
+                               slide_level,
+                               (read_size, read_size))
+    # Composite transparent areas (outside the scanned region) onto white.
+    patch = Image.new('RGB', region.size, (255, 255, 255))
+    patch.paste(region, mask=region)
+    if read_size != patch_size:
+        patch = patch.resize((patch_size, patch_size), Image.LANCZOS)
+    return np.array(patch, dtype=np.uint8)
+
+def get_tissue_mask(slide, tissue_threshold=220, thumbnail_size=2048):
+    ''' Finds tissue in a low resolution thumbnail of a slide, as the pixels darker than
+        tissue_threshold. Returns the boolean mask and the level 0 pixels per thumbnail pixel.
+    '''
+    thumbnail = slide.get_thumbnail((thumbnail_size, thumbnail_size)).convert('L')
+    tissue = np.array(thumbnail) < tissue_threshold
+    return tissue, float(slide.dimensions[0]) / tissue.shape[1]
+
+def is_tissue_tile(tiles, level, x, y, tile_size, overlap, tissue, thumbnail_scale):
+    ''' Whether the thumbnail shows any tissue within the tile at grid coords x, y, overlap included.
+        - tissue, thumbnail_scale   from get_tissue_mask()
+    '''
+    (offset_x, offset_y), downsample = get_level_geometry(tiles, level)
+    col0, row0 = [max(int((o + (t * tile_size - overlap) * downsample) / thumbnail_scale), 0)
+                  for o, t in [(offset_x, x), (offset_y, y)]]
+    col1, row1 = [int((o + ((t + 1) * tile_size + overlap) * downsample) / thumbnail_scale)
+                  for o, t in [(offset_x, x), (offset_y, y)]]
+    return bool(tissue[row0:row1 + 1, col0:col1 + 1].any())
+
+def get_random_locations(slide,
+                         tiles,
+                         level,
+                         patch_size,
+                         num_patches,
+                         rng,
+                         mask='none',
+                         regions=None,
+                         tissue_threshold=220,
+                         thumbnail_size=2048,
+                         max_attempts=100):
+    ''' Draws distinct random patch locations (top left pixel coords at the level) uniformly over the
+        level, or uniformly within a mask. Candidates are drawn in batches and rejected by the centre
+        of the patch, or if already drawn, so the cost depends on num_patches rather than on the slide
+        area.
+        - num_patches       number of locations to draw
+        - rng               a numpy RandomState
+        - mask              'none', 'tissue' (thumbnail pixels darker than tissue_threshold), or
+                            'annotation' (inside any of the regions)
+        - regions           region vertices in level 0 coords, for the annotation mask
+        - max_attempts      give up after drawing max_attempts * num_patches candidates
+
+        Returns an array of [x, y] rows, sorted in row-major order for sequential reads. Fewer than
+        num_patches locations are returned if the mask is too small.
+    '''
+    width, height = tiles.level_dimensions[level]
+    if width < patch_size or height < patch_size:
+        return np.zeros((0, 2), dtype=np.int64)
+    (offset_x, offset_y), downsample = get_level_geometry(tiles, level)
+
+    # Bounds (in level pixels) from which candidate top left corners are drawn.
+    x_min, y_min, x_max, y_max = 0, 0, width - patch_size, height - patch_size
+
+    if mask == 'tissue':
+        tissue, thumbnail_scale = get_tissue_mask(slide, tissue_threshold, thumbnail_size)
+    elif mask == 'annotation':
+        regions = [region for region in regions if len(region) >= 3]
+        if len(regions) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        polygons = []
+        for region in regions:
+            poly = geometry.Polygon(region)
+            polygons.append(prepared.prep(poly if poly.is_valid else poly.buffer(0)))
+
+        # Only draw candidates around the regions.
+        vertices = np.concatenate(regions)
+        x_min = max(int((vertices[:, 0].min() - offset_x) / downsample) - patch_size, 0)
+        y_min = max(int((vertices[:, 1].min() - offset_y) / downsample) - patch_size, 0)
+        x_max = min(int((vertices[:, 0].max() - offset_x) / downsample), width - patch_size)
+        y_max = min(int((vertices[:, 1].max() - offset_y) / downsample), height - patch_size)
+        if x_min > x_max or y_min > y_max:
+            return np.zeros((0, 2), dtype=np.int64)
+
+    locations, drawn = [], set()
+    attempts = 0
+    while len(locations) < num_patches and attempts < max_attempts * num_patches:
+        batch = max(2 * (num_patches - len(locations)), 16)
+        attempts += batch
+        xs = rng.randint(x_min, x_max + 1, size=batch)
+        ys = rng.randint(y_min, y_max + 1, size=batch)
+
+        # Level 0 coords of the patch centres.
+        centre_x = offset_x + (xs + patch_size / 2.0) * downsample
+        centre_y = offset_y + (ys + patch_size / 2.0) * downsample
+
+        if mask == 'tissue':
+            col = np.clip((centre_x / thumbnail_scale).astype(np.int64), 0, tissue.shape[1] - 1)
+            row = np.clip((centre_y / thumbnail_scale).astype(np.int64), 0, tissue.shape[0] - 1)
+            keep = tissue[row, col]
+        elif mask == 'annotation':
+            keep = np.array([any(p.contains(geometry.Point(cx, cy)) for p in polygons)
+                             for cx, cy in zip(centre_x, centre_y)], dtype=bool)
+        else:
+            keep = np.ones(batch, dtype=bool)
+
+        for x, y in zip(xs[keep], ys[keep]):
+            if len(locations) == num_patches:
+                break
+            # Locations are drawn without replacement, so that every patch is stored, once.
+            if (x, y) in drawn:
+                continue
+            drawn.add((x, y))
+            locations.append((x, y))
+
+    if len(locations) < num_patches:
+        print("[py-wsi]: only found", len(locations), "of", num_patches, "random patch locations in the mask.")
+    locations = np.array(sorted(locations, key=lambda l: (l[1], l[0])), dtype=np.int64).reshape(-1, 2)
+    return locations
+
+def slide_random_state(seed, file_name):
+    ''' A random state for one slide, which depends only on the seed and the file name, so that
+        each slide draws the same locations regardless of the order slides are sampled in.
+    '''
+    if seed is None:
+        return np.random.RandomState()
+    return np.random.RandomState((seed + zlib.crc32(file_name.encode('utf-8'))) % (2 ** 32))
+
+def iterate_tiles(tiles, level, patch_size, keep=None):
+    ''' Yields x, y, patch for every full-size tile of the level, in row-major order.
+        - keep          if given, only the tiles at grid coords x, y for which keep(x, y) is true are read
+    '''
+    x_tiles, y_tiles = tiles.level_tiles[level]
+    for y in range(y_tiles):
+        for x in range(x_tiles):
+            if keep is not None and not keep(x, y):
+                continue
+            new_tile = get_patch_tile(tiles, level, x, y, patch_size)
+            if new_tile is not None:
+                yield x, y, new_tile
+
+def get_slide_stains(slide, file_name, stain_cache=None, thumbnail_size=2048):
+    ''' Returns the stain matrix and maximum stain concentrations of a slide, estimated once from a
+        low resolution thumbnail and kept in stain_cache (if given) under the file name.
+    '''
+    if stain_cache is not None and file_name in stain_cache:
+        return stain_cache[file_name]
+
+    thumbnail = slide.get_thumbnail((thumbnail_size, thumbnail_size)).convert('RGB')
+    stains = estimate_stain_matrix(np.array(thumbnail, dtype=np.uint8))
+    if stain_cache is not None:
+        stain_cache[file_name] = stains
+    return stains
+
 def sample_and_store_patches(file_name,
                              file_dir,
                              pixel_overlap,
@@ -84,10 +340,25 @@ def sample_and_store_patches(file_name,
                              xml_dir=False,
                              label_map={},
                              limit_bounds=True,
-                             rows_per_txn=20,
+                             rows_per_txn=None,
                              db_location='',
                              prefix='',
-                             storage_option='lmdb'):
+                             storage_option='lmdb',
+                             dedup=False,
+                             codec='none',
+                             codec_workers=None,
+                             shard_writer=False,
+                             stain_normalise=False,
+                             stain_cache=None,
+                             stain_thumbnail_size=2048,
+                             roi_only=False,
+                             num_random=0,
+                             random_mask='none',
+                             seed=None,
+                             queue_size=2,
+                             txn_bytes=TXN_BYTES,
+                             core_tiles=False,
+                             stats=None):
     ''' Sample patches of specified size from .svs file.
         - file_name             name of whole slide image to sample from
         - file_dir              directory file is located in
@@ -96,8 +367,32 @@ def sample_and_store_patches(file_name,
         - level                 0 is lowest resolution; level_count - 1 is highest
         - xml_dir               directory containing annotation XML files
         - label_map             dictionary mapping string labels to integers
-        - rows_per_txn          how many patches to load into memory at once
+        - rows_per_txn          if set, also write after this many rows, even if txn_bytes is not reached
         - storage_option        the patch storage option              
+        - dedup                 for LMDB only; store identical patches once
+        - codec, codec_workers  for LMDB only; patch compression codec and encoding threads
+                                (shards take the codec from the ShardWriter)
+        - shard_writer          for shards only; the ShardWriter patches are appended to
+        - stain_normalise       stain-normalise patches before they are written
+        - stain_cache           dictionary of stain matrices per file; estimated matrices are added to it
+        - stain_thumbnail_size  maximum size of the low resolution image stains are estimated from
+        - roi_only              only read tiles which intersect the annotated regions (requires xml_dir)
+        - num_random            if > 0, sample this many random patch locations instead of the tile grid;
+                                coords are then the top left pixel coords at the level, not tile indices
+        - random_mask           where random locations are drawn: 'none', 'tissue' or 'annotation'
+        - seed                  seed for the random locations of this slide
+        - queue_size            blocks which may wait to be written. Blocks are written in a background
+                                thread while the next block is read, so reading and writing overlap; a full
+                                queue pauses reading, which bounds the memory used.
+        - txn_bytes             bytes of patches to buffer before writing them as one block, i.e. one
+                                transaction. At most queue_size + 2 blocks are held at once.
+        - core_tiles            for LMDB and the tile grid only; store the core of each tile once, without
+                                its overlap border, and patches as items which are assembled from the
+                                cores on read. Each patch is assembled when it is sampled, and stored whole
+                                instead if the result is not identical to the tile.
+        - stats                 dictionary; 'peak_buffered_bytes' is set to the most patch bytes held in
+                                memory at once, if larger than its current value, and with core_tiles, the
+                                patches assembled from cores are added to 'assembled_patches'
 
         Note: patch_size is the dimension of the sampled patches, NOT equivalent to openslide's definition
         of tile_size. This implementation was chosen to allow for more intuitive usage.
@@ -119,49 +414,328 @@ def sample_and_store_patches(file_name,
         return 0
     x_tiles, y_tiles = tiles.level_tiles[level]
 
-    x, y = 0, 0
-    count, batch_count = 0, 0
-    patches, coords, labels = [], [], []
-    while y < y_tiles:
-        while x < x_tiles:
-            new_tile = np.array(tiles.get_tile(level, (x, y)), dtype=np.uint8)
-            # OpenSlide calculates overlap in such a way that sometimes depending on the dimensions, edge
-            # patches are smaller than the others. We will ignore such patches.
-            if np.shape(new_tile) == (patch_size, patch_size, 3):
-                patches.append(new_tile)
-                coords.append(np.array([x, y]))
-                count += 1
-
-                # Calculate the patch label based on centre point.
-                if xml_dir:
-                    converted_coords = tiles.get_tile_coordinates(level, (x, y))[0]
-                    labels.append(generate_label(regions, region_labels, converted_coords, label_map))
-            x += 1
-
-        # To save memory, we will save data into the dbs every rows_per_txn rows. i.e., each transaction will commit
-        # rows_per_txn rows of patches. Write after last row regardless. HDF5 does NOT follow
-        # this convention due to efficiency.
-        if (y % rows_per_txn == 0 and y != 0) or y == y_tiles-1:
-            if storage_option == 'disk':
-                save_to_disk(db_location, patches, coords, file_name[:-4], labels)
-            elif storage_option == 'lmdb':
-                # LMDB by default.
-                save_in_lmdb(env, patches, coords, file_name[:-4], labels)
-            if storage_option != 'hdf5':
-                del patches
-                del coords
-                del labels
-                patches, coords, labels = [], [], [] # Reset right away.
-
-        y += 1
-        x = 0
-
-    # Write to HDF5 files all in one go.
+    if (roi_only or random_mask == 'annotation') and not xml_dir:
+        print("[py-wsi error]: sampling within annotated regions requires XML annotations.")
+        return 0
+
+    # The locations to read, in rows. Grid rows hold tile indices; random locations are split
+    # into rows of the same length as a grid row, so rows_per_txn keeps its meaning.
+    if num_random > 0:
+        locations = get_random_locations(slide, tiles, level, patch_size, num_random,
+                                         slide_random_state(seed, file_name),
+                                         mask=random_mask,
+                                         regions=regions if xml_dir else None)
+        rows = [locations[i:i + x_tiles] for i in range(0, len(locations), x_tiles)]
+        dims = list(tiles.level_dimensions[level])
+        (offset_x, offset_y), downsample = get_level_geometry(tiles, level)
+    elif roi_only:
+        roi_rows = get_roi_rows(tiles, level, tile_size, pixel_overlap, regions)
+        rows = [[(x, y) for x in roi_rows.get(y, [])] for y in range(y_tiles)]
+        dims = [x_tiles, y_tiles]
+    else:
+        rows = [[(x, y) for x in range(x_tiles)] for y in range(y_tiles)]
+        dims = [x_tiles, y_tiles]
+
+    if storage_option == 'lmdb':
+        slide_id = get_slide_id(meta_env, file_name[:-4])
+
+    if stain_normalise:
+        stains = get_slide_stains(slide, file_name, stain_cache, stain_thumbnail_size)
+
+    if core_tiles:
+        # Rows of neighbouring tiles whose cores a patch overlaps, above and below.
+        reach = -(-pixel_overlap // tile_size)
+        level_width, level_height = tiles.level_dimensions[level]
+        # Cores read so far by row, patches waiting for the rows below them, and the cores stored.
+        tile_cores, pending, stored_cores = {}, [], set()
+
+    if storage_option == 'npy':
+        # Preallocate for every location; rows for discarded edge tiles are dropped when closing.
+        patch_array = new_npy(db_location + prefix, file_name[:-4], sum(len(row) for row in rows), patch_size)
+        npy_offset = 0
+        all_coords, all_labels = [], []
+
     if storage_option == 'hdf5':
-        save_to_hdf5(db_location, patches, coords, file_name[:-4], labels)
+        hdf5_file = new_hdf5(db_location, file_name[:-4], patch_size)
+
+    def write_block(patches, coords, labels, patch_tiles, cores, core_coords):
+        nonlocal npy_offset
+
+        # Normalise the block as one batch. Core tiles were normalised as they were read.
+        if stain_normalise and not core_tiles:
+            patches = list(normalise_patches(patches, *stains))
+
+        if storage_option == 'disk':
+            save_to_disk(db_location, patches, coords, file_name[:-4], labels)
+        elif storage_option == 'lmdb':
+            # LMDB by default.
+            if len(cores) > 0:
+                # Before the patches, so that no stored patch refers to a missing core.
+                save_cores_in_lmdb(env, cores, core_coords, slide_id, codec=codec, codec_workers=codec_workers)
+            save_in_lmdb(env, patches, coords, file_name[:-4], labels, dedup=dedup,
+                         codec=codec, codec_workers=codec_workers, slide_id=slide_id, tiles=patch_tiles)
+        elif storage_option == 'shards':
+            shard_writer.write(patches, coords, file_name[:-4], labels, codec_workers=codec_workers)
+        elif storage_option == 'npy':
+            npy_offset = save_to_npy(patch_array, npy_offset, patches)
+            all_coords.extend(coords)
+            all_labels.extend(labels)
+        elif storage_option == 'hdf5':
+            save_to_hdf5(db_location, patches, coords, file_name[:-4], labels, file=hdf5_file)
+
+    # Blocks are written by this thread while the next ones are read. After an error it keeps
+    # taking blocks, so that the reader is never blocked, but stops writing them.
+    blocks = queue.Queue(maxsize=queue_size)
+    done = object()
+    errors = []
+
+    # Bytes of patches read but not yet written, and the most held at once.
+    buffered = {'bytes': 0, 'peak': 0}
+    buffered_lock = threading.Lock()
+
+    def writer():
+        while True:
+            block = blocks.get()
+            if block is done:
+                return
+            if len(errors) == 0:
+                try:
+                    write_block(*block[:-1])
+                except Exception as e:
+                    errors.append(e)
+            with buffered_lock:
+                buffered['bytes'] -= block[-1]
+
+    def flush():
+        nonlocal patches, coords, labels, patch_tiles, cores, core_coords, block_bytes
+        if len(patches) > 0 or len(cores) > 0:
+            blocks.put((patches, coords, labels, patch_tiles, cores, core_coords, block_bytes))
+        patches, coords, labels, patch_tiles, cores, core_coords = [], [], [], [], [], [] # Reset right away.
+        block_bytes = 0
+
+    def buffer_bytes(nbytes):
+        nonlocal block_bytes
+        block_bytes += nbytes
+        with buffered_lock:
+            buffered['bytes'] += nbytes
+            buffered['peak'] = max(buffered['peak'], buffered['bytes'])
+
+    def add_patch(x, y, new_tile, tiled=None):
+        nonlocal count
+        patches.append(new_tile)
+        coords.append(np.array([x, y]))
+        patch_tiles.append(tiled)
+        count += 1
+        buffer_bytes(new_tile.nbytes)
+
+        # Calculate the patch label based on centre point.
+        if xml_dir:
+            if num_random > 0:
+                converted_coords = (offset_x + x * downsample, offset_y + y * downsample)
+            else:
+                converted_coords = tiles.get_tile_coordinates(level, (x, y))[0]
+            labels.append(generate_label(regions, region_labels, converted_coords, label_map))
+
+        # To save memory, write a block whenever txn_bytes of patches are buffered,
+        # whatever the width of the slide and the size of the patches.
+        if block_bytes >= txn_bytes:
+            flush()
+
+    def read_core(x, y):
+        tile = np.array(tiles.get_tile(level, (x, y)), dtype=np.uint8)
+        if stain_normalise:
+            tile = normalise_patches(tile[None], *stains)[0]
+        tile_cores.setdefault(y, {})[x] = get_tile_core(tile, tiles, level, x, y, tile_size, pixel_overlap)
+        return tile
+
+    def store_pending(last_row=None):
+        # Stores the pending patches whose rows of neighbouring cores have all been read, up to
+        # last_row; all of them if None.
+        nonlocal pending, assembled
+        ready = [p for p in pending if last_row is None or p[1] + reach <= last_row]
+        pending = [p for p in pending if last_row is not None and p[1] + reach > last_row]
+        for x, y, new_tile in ready:
+            used = []
+            def get_core(i, j):
+                # Tiles outside the sampled rows, e.g. beyond the regions of interest, are read here.
+                if i not in tile_cores.get(j, {}):
+                    read_core(i, j)
+                used.append((i, j))
+                return tile_cores[j][i]
+
+            # With overlap > tile_size, the borders of patches near the edges reach beyond the level.
+            inside = (min(x, y) * tile_size >= pixel_overlap and
+                      (x + 1) * tile_size + pixel_overlap <= level_width and
+                      (y + 1) * tile_size + pixel_overlap <= level_height)
+            if inside and np.array_equal(assemble_patch(get_core, x, y, tile_size, pixel_overlap), new_tile):
+                for i, j in used:
+                    if (i, j) not in stored_cores:
+                        stored_cores.add((i, j))
+                        cores.append(tile_cores[j][i])
+                        core_coords.append((i, j))
+                        buffer_bytes(tile_cores[j][i].nbytes)
+                add_patch(x, y, new_tile, (tile_size, pixel_overlap))
+                assembled += 1
+            else:
+                # Tiles resampled from another slide level may differ where they overlap.
+                add_patch(x, y, new_tile)
+
+        # The patches still pending only need the cores from reach rows above their own.
+        if last_row is not None:
+            for j in [j for j in tile_cores if j <= last_row - 2 * reach]:
+                del tile_cores[j]
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+
+    count, block_bytes, assembled = 0, 0, 0
+    patches, coords, labels, patch_tiles, cores, core_coords = [], [], [], [], [], []
+    try:
+        for r, row in enumerate(rows):
+            for x, y in row:
+                if num_random > 0:
+                    new_tile = read_level_patch(slide, tiles, level, x, y, patch_size)
+                elif core_tiles:
+                    new_tile = read_core(x, y)
+                    # Full-size tiles wait for the rows below them; the reach rows this holds are
+                    # not counted as buffered.
+                    if np.shape(new_tile) == (patch_size, patch_size, 3):
+                        pending.append((x, y, new_tile))
+                    continue
+                else:
+                    new_tile = get_patch_tile(tiles, level, x, y, patch_size)
+                if new_tile is not None:
+                    add_patch(x, y, new_tile)
+
+            if core_tiles:
+                store_pending(r)
+            if len(errors) > 0:
+                break
+            if rows_per_txn and r % rows_per_txn == 0 and r != 0:
+                flush()
+        if core_tiles:
+            store_pending()
+        # Write after last row regardless.
+        flush()
+    finally:
+        blocks.put(done)
+        thread.join()
+        if storage_option == 'hdf5':
+            close_hdf5(hdf5_file)
+    if len(errors) > 0:
+        raise errors[0]
+
+    if stats is not None:
+        stats['peak_buffered_bytes'] = max(stats.get('peak_buffered_bytes', 0), buffered['peak'])
+        if core_tiles:
+            stats['assembled_patches'] = stats.get('assembled_patches', 0) + assembled
+
+    if storage_option == 'npy':
+        # Release the memmap before close_npy() truncates its file.
+        patch_shape = patch_array.shape[1:]
+        patch_array.flush()
+        patch_array = None
+        close_npy(db_location + prefix, file_name[:-4], patch_shape, all_coords, all_labels)
 
     # Need to save tile dimensions if LMDB for retrieving patches by key.
     if storage_option == 'lmdb':
-        save_meta_in_lmdb(meta_env, file_name[:-4], [x_tiles, y_tiles])
+        save_meta_in_lmdb(meta_env, file_name[:-4], dims, slide_id)
 
     return count
+
+def predict_slide(file_name,
+                  file_dir,
+                  pixel_overlap,
+                  fn,
+                  patch_size=512,
+                  level=0,
+                  batch_size=64,
+                  limit_bounds=True,
+                  queue_size=4,
+                  tissue_only=False,
+                  tissue_threshold=220,
+                  thumbnail_size=2048):
+    ''' Runs fn over every full-size tile of a slide without storing any patches, and assembles
+        the outputs into a heatmap indexed by tile coords. Tiles are read in a background thread
+        into a queue of at most queue_size batches, so reading overlaps with fn and memory stays
+        constant per slide.
+        - fn                    callable taking a uint8 batch of shape (B, patch_size, patch_size, 3)
+                                and returning B outputs, either scalars or vectors of length K
+        - batch_size            number of tiles per call to fn
+        - tissue_only           only read and predict tiles with tissue in a thumbnail of the slide
+        - tissue_threshold      thumbnail pixels darker than this are tissue
+        - thumbnail_size        maximum size of the thumbnail
+        - other parameters      as for sample_and_store_patches()
+
+        Returns a float32 heatmap of shape (y_tiles, x_tiles) or (y_tiles, x_tiles, K); tiles which
+        were not predicted (edge tiles, and background with tissue_only) are NaN. Returns None if the
+        level does not exist.
+    '''
+    tile_size = patch_to_tile_size(patch_size, pixel_overlap)
+    slide = open_slide(file_dir + file_name)
+    tiles = DeepZoomGenerator(slide,
+                              tile_size=tile_size,
+                              overlap=pixel_overlap,
+                              limit_bounds=limit_bounds)
+
+    if level >= tiles.level_count:
+        print("[py-wsi error]: requested level does not exist. Number of slide levels: " + str(tiles.level_count))
+        return None
+    x_tiles, y_tiles = tiles.level_tiles[level]
+
+    keep = None
+    if tissue_only:
+        tissue, thumbnail_scale = get_tissue_mask(slide, tissue_threshold, thumbnail_size)
+        keep = lambda x, y: is_tissue_tile(tiles, level, x, y, tile_size, pixel_overlap, tissue, thumbnail_scale)
+
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def reader():
+        try:
+            patches, coords = [], []
+            for x, y, new_tile in iterate_tiles(tiles, level, patch_size, keep):
+                if stop.is_set():
+                    return
+                patches.append(new_tile)
+                coords.append((x, y))
+                if len(patches) == batch_size:
+                    batches.put((np.stack(patches), np.array(coords)))
+                    patches, coords = [], []
+            if len(patches) > 0:
+                batches.put((np.stack(patches), np.array(coords)))
+        except Exception as e:
+            batches.put(e)
+        batches.put(done)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+
+    heatmap = None
+    try:
+        while True:
+            batch = batches.get()
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+
+            patches, coords = batch
+            outputs = np.asarray(fn(patches), dtype=np.float32).reshape(len(patches), -1)
+            if heatmap is None:
+                shape = (y_tiles, x_tiles) if outputs.shape[1] == 1 else (y_tiles, x_tiles, outputs.shape[1])
+                heatmap = np.full(shape, np.nan, dtype=np.float32)
+            heatmap[coords[:, 1], coords[:, 0]] = outputs if heatmap.ndim == 3 else outputs[:, 0]
+    finally:
+        # Unblock and stop the reader if fn raised.
+        stop.set()
+        while thread.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    if heatmap is None:
+        heatmap = np.full((y_tiles, x_tiles), np.nan, dtype=np.float32)
+    return heatmap
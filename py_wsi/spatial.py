@@ -0,0 +1,81 @@
+'''
+
+Spatial index over the coords of the stored patches of one slide, so that the patches within a
+bounding box or polygon can be found, and read on their own, without loading the whole slide.
+
+Author: @ysbecca
+
+'''
+import math
+
+import numpy as np
+
+from .helpers import lazy_import
+
+# Imported on first use.
+geometry = lazy_import('shapely.geometry')
+prepared = lazy_import('shapely.prepared')
+
+
+# Average number of patches per bucket that the default bucket size aims for.
+PATCHES_PER_BUCKET = 16
+
+
+class GridIndex(object):
+
+    def __init__(self, coords, locators, bucket_size=None):
+        """ Buckets the coords of the stored patches of a slide into a grid of square buckets.
+            - coords        x, y coords of each patch
+            - locators      where each patch is stored, e.g. its LMDB key or row; queries return
+                            indices into coords and locators
+            - bucket_size   side of a bucket in coord units; by default chosen from the density of
+                            the coords, so that about PATCHES_PER_BUCKET patches share a bucket
+        """
+        self.coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+        self.locators = list(locators)
+        self.bucket_size = bucket_size if bucket_size is not None else self.__default_bucket_size()
+
+        self.buckets = {}
+        for i, (bx, by) in enumerate((self.coords // self.bucket_size).tolist()):
+            self.buckets.setdefault((bx, by), []).append(i)
+
+    def __len__(self):
+        return len(self.locators)
+
+    def query_bbox(self, x_min, y_min, x_max, y_max):
+        """ Returns the indices of the patches whose coords are within the box, bounds included,
+            in storage order.
+        """
+        b = self.bucket_size
+        bx_range = range(int(math.floor(x_min / b)), int(math.floor(x_max / b)) + 1)
+        by_range = range(int(math.floor(y_min / b)), int(math.floor(y_max / b)) + 1)
+
+        # Look up the buckets under the box, or go through the buckets there are if that is fewer.
+        if len(bx_range) * len(by_range) <= len(self.buckets):
+            found = [i for bx in bx_range for by in by_range for i in self.buckets.get((bx, by), [])]
+        else:
+            found = [i for (bx, by), bucket in self.buckets.items()
+                     if bx in bx_range and by in by_range for i in bucket]
+
+        found = np.array(sorted(found), dtype=np.int64)
+        coords = self.coords[found]
+        inside = ((coords[:, 0] >= x_min) & (coords[:, 0] <= x_max) &
+                  (coords[:, 1] >= y_min) & (coords[:, 1] <= y_max))
+        return found[inside]
+
+    def query_polygon(self, vertices):
+        """ Returns the indices of the patches whose coords are within the polygon with the given
+            vertices, boundary included, in storage order.
+        """
+        polygon = geometry.Polygon(vertices)
+        found = self.query_bbox(*polygon.bounds)
+        region = prepared.prep(polygon)
+        inside = [region.covers(geometry.Point(x, y)) for x, y in self.coords[found].tolist()]
+        return found[np.array(inside, dtype=bool)]
+
+    def __default_bucket_size(self):
+        if len(self.coords) == 0:
+            return 1
+        extent = self.coords.max(axis=0) - self.coords.min(axis=0) + 1
+        area_per_patch = float(extent[0]) * float(extent[1]) / len(self.coords)
+        return max(1, int(round(math.sqrt(PATCHES_PER_BUCKET * area_per_patch))))
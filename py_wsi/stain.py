@@ -0,0 +1,98 @@
+'''
+
+Stain normalisation of H&E patches using the method of Macenko et al., "A method for normalizing
+histology slides for quantitative analysis" (ISBI 2009).
+
+The stain matrix of a slide is estimated once from a low resolution image of the whole slide, and
+then applied to batches of patches in a single vectorised operation, so that patches can be
+normalised as they are sampled rather than every time they are loaded.
+
+Author: @ysbecca
+
+'''
+
+import numpy as np
+
+
+# Reference H&E stain vectors (columns) and 99th percentile stain concentrations that patches are
+# normalised to, as commonly used with Macenko's method.
+REFERENCE_STAIN_MATRIX = np.array([[0.5626, 0.2159],
+                                   [0.7201, 0.8012],
+                                   [0.4062, 0.5581]], dtype=np.float32)
+REFERENCE_MAX_CONCENTRATIONS = np.array([1.9705, 1.0308], dtype=np.float32)
+
+# Transmitted light intensity, i.e. the brightness of the background.
+BACKGROUND_INTENSITY = 240
+
+
+def rgb_to_od(pixels, io=BACKGROUND_INTENSITY):
+    ''' Converts RGB pixels to optical density. '''
+    return -np.log((pixels.astype(np.float32) + 1) / io)
+
+def estimate_stain_matrix(image, alpha=1, beta=0.15, io=BACKGROUND_INTENSITY):
+    ''' Estimates the H&E stain matrix and maximum stain concentrations of an RGB image,
+        typically a thumbnail of the whole slide.
+        - alpha         percentile used to find robust extreme stain angles
+        - beta          optical density below which pixels are treated as background
+
+        Returns the (3, 2) stain matrix with haematoxylin first, and the 99th percentile
+        concentration of each stain.
+    '''
+    od = rgb_to_od(np.asarray(image)[..., :3].reshape(-1, 3), io)
+
+    # Ignore transparent (background) pixels.
+    od_tissue = od[~np.any(od < beta, axis=1)]
+    if len(od_tissue) < 2:
+        print("[py-wsi error]: no tissue found to estimate the stain matrix; using the reference.")
+        return REFERENCE_STAIN_MATRIX, REFERENCE_MAX_CONCENTRATIONS
+
+    # Project onto the plane of the two largest eigenvectors of the OD covariance.
+    _, eigvecs = np.linalg.eigh(np.cov(od_tissue.T))
+    plane = od_tissue.dot(eigvecs[:, 1:3])
+
+    # The stain vectors are at the extreme angles within this plane.
+    phi = np.arctan2(plane[:, 1], plane[:, 0])
+    min_phi = np.percentile(phi, alpha)
+    max_phi = np.percentile(phi, 100 - alpha)
+    v_min = eigvecs[:, 1:3].dot(np.array([np.cos(min_phi), np.sin(min_phi)]))
+    v_max = eigvecs[:, 1:3].dot(np.array([np.cos(max_phi), np.sin(max_phi)]))
+
+    # Haematoxylin has the larger red component.
+    if v_min[0] > v_max[0]:
+        stain_matrix = np.array([v_min, v_max]).T
+    else:
+        stain_matrix = np.array([v_max, v_min]).T
+    # Optical densities are positive; eigenvectors may come out negated.
+    stain_matrix = stain_matrix * np.sign(stain_matrix.sum(axis=0))
+
+    concentrations = np.linalg.lstsq(stain_matrix, od.T, rcond=None)[0]
+    max_concentrations = np.percentile(concentrations, 99, axis=1)
+    return stain_matrix.astype(np.float32), max_concentrations.astype(np.float32)
+
+def normalise_patches(patches,
+                      stain_matrix,
+                      max_concentrations,
+                      target_matrix=REFERENCE_STAIN_MATRIX,
+                      target_max_concentrations=REFERENCE_MAX_CONCENTRATIONS,
+                      io=BACKGROUND_INTENSITY,
+                      chunk_size=64):
+    ''' Normalises a batch of RGB patches (N, H, W, 3) from a slide with the given stain matrix
+        and maximum concentrations to the target stains. Each chunk of chunk_size patches is
+        normalised in one vectorised operation, which bounds the float working memory.
+
+        Returns the normalised uint8 patches with the same shape.
+    '''
+    patches = np.asarray(patches)
+    normalised = np.empty(patches.shape[:-1] + (3,), dtype=np.uint8)
+
+    # Maps optical density to stain concentrations rescaled to the target maximum concentrations,
+    # and then back to the optical density of the target stains.
+    to_concentrations = np.linalg.pinv(stain_matrix) * (target_max_concentrations / max_concentrations)[:, None]
+    transform = target_matrix.dot(to_concentrations).astype(np.float32)
+
+    for start in range(0, len(patches), chunk_size):
+        chunk = patches[start:start + chunk_size, ..., :3]
+        od = rgb_to_od(chunk, io)
+        rgb = io * np.exp(-od.dot(transform.T))
+        normalised[start:start + chunk_size] = np.clip(rgb, 0, 255)
+    return normalised
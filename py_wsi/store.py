@@ -6,52 +6,300 @@ Author: @ysbecca
 
 
 '''
+import contextlib
 import csv
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import shutil
+import struct
+import tarfile
+import threading
 import time
-import h5py
 from datetime import timedelta
 
-from PIL import Image
-
-import lmdb
 import numpy as np
 from .item import *
+from .compress import *
+from .config import *
+from .helpers import lazy_import
+
+# Storage backends are imported on first use, so e.g. an LMDB reader never needs h5py.
+h5py = lazy_import('h5py')
+lmdb = lazy_import('lmdb')
+Image = lazy_import('PIL.Image')
 
 
 ###########################################################################
 #                Option 1: Save to LMDB                                   #
 ###########################################################################
 
-def save_in_lmdb(env, patches, coords, file_name, labels=[]):
+# Meta database key under which the patch codec is recorded.
+CODEC_KEY = b'__codec__'
+
+# Meta database key holding the next unused slide id.
+SLIDE_ID_KEY = b'__next_slide_id__'
+
+# Keys of deduplicated patch payloads start with this prefix, followed by the content hash.
+PAYLOAD_PREFIX = b'#'
+
+# Patch keys are fixed-width big-endian (slide id, y, x), so that LMDB's byte order is the
+# numeric storage order and all patches of a slide form one contiguous key range.
+KEY_FORMAT = '>III'
+KEY_SIZE = struct.calcsize(KEY_FORMAT)
+
+# Keys of the core tiles of patches stored with core_tiles start with this prefix, followed by
+# the patch key of the tile.
+CORE_PREFIX = b'c'
+
+def lmdb_key(slide_id, x, y):
+    return struct.pack(KEY_FORMAT, slide_id, y, x)
+
+def core_key(slide_id, x, y):
+    return CORE_PREFIX + lmdb_key(slide_id, x, y)
+
+def parse_lmdb_key(key):
+    """ Returns slide_id, x, y of a binary patch key. """
+    slide_id, y, x = struct.unpack(KEY_FORMAT, key)
+    return slide_id, x, y
+
+def legacy_lmdb_key(file_name, x, y):
+    # Key format of databases written before binary keys: ASCII 'file-x-y'.
+    return (file_name + '-' + str(x) + '-' + str(y)).encode('ascii')
+
+def patch_digest(patch):
+    """ Content hash of a patch; the shape is included so equal bytes of different shapes never collide.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(patch.shape).encode('ascii'))
+    h.update(patch.tobytes())
+    return h.digest()
+
+def save_in_lmdb(env, patches, coords, file_name, labels=[], dedup=False, codec='none', codec_workers=None,
+                 slide_id=None, tiles=None):
+    """ Saves patches and their meta into LMDB, one item per patch keyed by slide id and coords.
+        - slide_id      id from get_slide_id(); without one, the legacy 'file-x-y' keys are written
+        - dedup         store each unique patch payload once; coordinate keys then hold a small
+                        item referring to the shared payload, which is resolved on read.
+        - codec         codec to compress the pixels with (see compress.py)
+        - codec_workers number of threads encoding patches before the transaction is opened
+        - tiles         for each patch, (tile_size, overlap) if it is assembled from the core tiles
+                        saved by save_cores_in_lmdb() on read, so its pixels are not stored; or None
+    """
     use_label = False
     if len(labels) > 0:
         use_label = True
+    if tiles is None:
+        tiles = [None] * len(patches)
+
+    # Work out which patches carry pixels, so that each payload is only encoded once.
+    refs = [None] * len(patches)
+    to_encode = [i for i in range(len(patches)) if tiles[i] is None]
+    if dedup:
+        refs = [PAYLOAD_PREFIX + patch_digest(p) if t is None else None for p, t in zip(patches, tiles)]
+        first = {}
+        for i in to_encode:
+            first.setdefault(refs[i], i)
+        to_encode = sorted(first.values())
+    encoded = dict(zip(to_encode, encode_patches([patches[i] for i in to_encode], codec, codec_workers)))
 
     with env.begin(write=True) as txn:
         # txn is a Transaction object
         for i in range(len(patches)):
-            if use_label:
-                item = Item(patches[i], coords[i], labels[i])
+            label = labels[i] if use_label else 0
+
+            if tiles[i] is not None:
+                item = Item(None, coords[i], label, shape=patches[i].shape, tiles=tiles[i])
+            elif dedup:
+                if i in encoded:
+                    # Only the first occurrence of a payload is written.
+                    payload = Item(patches[i], coords[i], label, codec=codec, data=encoded[i])
+                    txn.put(refs[i], pickle.dumps(payload), overwrite=False)
+                item = Item(patches[i], coords[i], label, ref=refs[i], codec=codec)
             else:
-                item = Item(patches[i], coords[i], 0)
+                item = Item(patches[i], coords[i], label, codec=codec, data=encoded[i])
 
-            str_id = file_name + '-' + str(coords[i][0]) + '-' + str(coords[i][1])
-            txn.put(str_id.encode('ascii'), pickle.dumps(item))
+            if slide_id is None:
+                key = legacy_lmdb_key(file_name, coords[i][0], coords[i][1])
+            else:
+                key = lmdb_key(slide_id, int(coords[i][0]), int(coords[i][1]))
+            txn.put(key, pickle.dumps(item))
 
-def save_meta_in_lmdb(meta_env, file, tile_dims):
-    # Saves all tile dimension info along with file name, for loading patches.
+def save_cores_in_lmdb(env, cores, coords, slide_id, codec='none', codec_workers=None):
+    """ Saves the core tiles of a slide, i.e. the tiles without their overlap border, from which
+        patches saved with tiles are assembled (see assemble_patch()).
+        - cores         core pixels of each tile; those at the right and bottom edges of the level
+                        may be smaller than the others
+        - coords        tile grid coords of each core
+        - other parameters as for save_in_lmdb()
+    """
+    encoded = encode_patches(cores, codec, codec_workers)
+    with env.begin(write=True) as txn:
+        for i in range(len(cores)):
+            item = Item(None, coords[i], 0, codec=codec, data=encoded[i], shape=cores[i].shape)
+            txn.put(core_key(slide_id, int(coords[i][0]), int(coords[i][1])), pickle.dumps(item))
+
+def assemble_patch(get_core, x, y, tile_size, overlap):
+    """ Assembles the patch of the tile at grid coords x, y, overlap border included, from the
+        cores of the tiles it covers.
+        - get_core      returns the core of the tile at grid coords i, j
+    """
+    size = tile_size + 2 * overlap
+    # Level pixel coords of the top left of the patch.
+    left, top = x * tile_size - overlap, y * tile_size - overlap
+    patch = None
+    for j in range(top // tile_size, (top + size - 1) // tile_size + 1):
+        for i in range(left // tile_size, (left + size - 1) // tile_size + 1):
+            core = get_core(i, j)
+            if patch is None:
+                patch = np.empty((size, size) + core.shape[2:], dtype=core.dtype)
+            # The part of the core within the patch.
+            x0, x1 = max(i * tile_size, left), min(i * tile_size + core.shape[1], left + size)
+            y0, y1 = max(j * tile_size, top), min(j * tile_size + core.shape[0], top + size)
+            patch[y0 - top:y1 - top, x0 - left:x1 - left] = \
+                core[y0 - j * tile_size:y1 - j * tile_size, x0 - i * tile_size:x1 - i * tile_size]
+    return patch
+
+def save_encoded_in_lmdb(env, encoded, shapes, coords, labels=[], codec='none', slide_id=None, file_name=''):
+    """ Saves patches which are already encoded with codec into LMDB, without decoding them.
+        - encoded       encoded pixels of each patch, e.g. from encode_patch()
+        - shapes        shape of each patch
+        - other parameters as for save_in_lmdb()
+    """
+    with env.begin(write=True) as txn:
+        for i in range(len(encoded)):
+            label = labels[i] if len(labels) > 0 else 0
+            item = Item(None, coords[i], label, codec=codec, data=encoded[i], shape=shapes[i])
+            if slide_id is None:
+                key = legacy_lmdb_key(file_name, coords[i][0], coords[i][1])
+            else:
+                key = lmdb_key(slide_id, int(coords[i][0]), int(coords[i][1]))
+            txn.put(key, pickle.dumps(item))
+
+def get_slide_id(meta_env, file):
+    """ Returns the slide id of a file in the meta database, allocating the next free id if
+        the file has not been stored yet.
+    """
+    with meta_env.begin(write=True) as txn:
+        raw_dims = txn.get(file.encode('ascii'))
+        if raw_dims is not None:
+            dims = pickle.loads(raw_dims)
+            if len(dims) > 2:
+                return dims[2]
+
+        raw_id = txn.get(SLIDE_ID_KEY)
+        slide_id = pickle.loads(raw_id) if raw_id is not None else 0
+        txn.put(SLIDE_ID_KEY, pickle.dumps(slide_id + 1))
+    return slide_id
+
+def save_meta_in_lmdb(meta_env, file, tile_dims, slide_id=None):
+    # Saves all tile dimension info along with file name and slide id, for loading patches.
+    # Meta without a slide id marks a database with legacy 'file-x-y' keys.
+    if slide_id is not None:
+        tile_dims = list(tile_dims) + [slide_id]
     with meta_env.begin(write=True) as txn:
         txn.put(file.encode('ascii'), pickle.dumps(tile_dims))
 
-def get_patch_from_lmdb(txn, x, y, file_name):
-    str_id = file_name + '-' + str(x) + '-' + str(y)
-    raw_item = txn.get(str_id.encode('ascii'))
+def save_codec_in_lmdb(meta_env, codec):
+    # Records the codec of the patch database alongside the tile dimensions.
+    with meta_env.begin(write=True) as txn:
+        txn.put(CODEC_KEY, codec.encode('ascii'))
+
+def get_codec_from_lmdb(meta_env):
+    # Databases written before codecs existed store raw pixels.
+    with read_txn(meta_env) as txn:
+        codec = txn.get(CODEC_KEY)
+    return codec.decode('ascii') if codec is not None else 'none'
+
+def get_patch_from_lmdb(txn, x, y, file_name, slide_id=None):
+    """ Fetches a single item by its coords; returns None if there is no patch at these coords.
+        - slide_id      the slide id from the meta database; None reads legacy 'file-x-y' keys
+    """
+    if slide_id is None:
+        key = legacy_lmdb_key(file_name, x, y)
+    else:
+        key = lmdb_key(slide_id, x, y)
+    raw_item = txn.get(key)
+    if raw_item is None:
+        return None
+    return _load_item(txn, raw_item, slide_id)
+
+def get_slide_items_from_lmdb(txn, slide_id):
+    """ Fetches all items of one slide with a single cursor scan over its key range, in storage
+        (row-major) order. Missing tiles are simply not in the range.
+    """
+    return list(iter_slide_items_from_lmdb(txn, slide_id))
+
+def iter_slide_items_from_lmdb(txn, slide_id):
+    """ As get_slide_items_from_lmdb(), but yields the items one at a time, so that a slide can
+        be streamed without holding all its items in memory.
+    """
+    prefix = struct.pack('>I', slide_id)
+    cursor = txn.cursor()
+    if not cursor.set_range(prefix):
+        return
+    # Decoded core tiles, shared by the neighbouring patches assembled from them.
+    cores = {}
+    for key, raw_item in cursor:
+        if key[:len(prefix)] != prefix:
+            break
+        if len(key) == KEY_SIZE:
+            yield _load_item(txn, raw_item, slide_id, cores)
+
+def count_slide_items_in_lmdb(txn, slide_id):
+    """ Counts the items of one slide by scanning its keys only. """
+    return sum(1 for _ in iter_slide_keys_in_lmdb(txn, slide_id))
+
+def iter_slide_keys_in_lmdb(txn, slide_id):
+    """ Yields the patch keys of one slide in storage order, without reading the items. """
+    prefix = struct.pack('>I', slide_id)
+    cursor = txn.cursor()
+    if not cursor.set_range(prefix):
+        return
+    for key in cursor.iternext(values=False):
+        if key[:len(prefix)] != prefix:
+            break
+        if len(key) == KEY_SIZE:
+            yield key
+
+def _load_item(txn, raw_item, slide_id=None, cores=None):
+    """ Unpickles an item, resolving its pixels if they are stored elsewhere.
+        - cores         dictionary of decoded core tiles by row, kept between calls for patches read
+                        in storage order; rows no longer needed are dropped from it
+    """
     item = pickle.loads(raw_item)
+    # Items written before deduplication existed have no ref attribute.
+    if getattr(item, 'ref', None):
+        item.resolve(pickle.loads(txn.get(item.ref)))
+    elif getattr(item, 'tiles', None):
+        item.assemble(_assemble_item_patch(txn, item, slide_id, cores if cores is not None else {}))
     return item
 
+def _assemble_item_patch(txn, item, slide_id, cores):
+    tile_size, overlap = item.tiles
+    x, y = int(item.coords[0]), int(item.coords[1])
+
+    # Later patches in storage order are in this row or below, so never need the rows above.
+    top = (y * tile_size - overlap) // tile_size
+    for j in [j for j in cores if j < top]:
+        del cores[j]
+
+    def get_core(i, j):
+        row = cores.setdefault(j, {})
+        if i not in row:
+            row[i] = pickle.loads(txn.get(core_key(slide_id, i, j))).get_patch()
+        return row[i]
+
+    return assemble_patch(get_core, x, y, tile_size, overlap)
+
 def get_meta_from_lmdb(meta_env, file):
     # Call get_meta_from_lmdb(read_lmdb(location, name), file) for single read
-    with meta_env.begin() as txn:
+    with read_txn(meta_env) as txn:
         raw_dims = txn.get(file.encode())
         dims = pickle.loads(raw_dims)
     return dims
@@ -60,41 +308,181 @@ def new_lmdb(location, name, map_size_bytes):
     return lmdb.open(location + name, map_size=map_size_bytes)
 
 def print_lmdb_keys(env):
-    with env.begin() as txn:
+    with read_txn(env) as txn:
         cursor = txn.cursor()
         for key, value in cursor:
             print(key)
 
-def read_lmdb(location, name):
-    ''' Read-only allows for multiple consecutive reads. '''
-    return lmdb.open(location + name, readonly=True)
+def read_lmdb(location, name, readahead=LMDB_READAHEAD, lock=LMDB_LOCK, max_spare_txns=LMDB_SPARE_TXNS):
+    ''' Read-only allows for multiple consecutive reads. The environment can be shared by any
+        number of threads of the process which opened it, but not by a forked child.
+        - readahead         let the OS read ahead of the pages accessed
+        - lock              use the lock table; without it, the database must not be read while
+                            another process writes to it
+        - max_spare_txns    read transactions kept for reuse rather than allocated by each read
+    '''
+    if lock:
+        # Each spare transaction holds a slot in the lock table, which a forked child would free
+        # for its parent when closing its copy of the environment.
+        max_spare_txns = 0
+    return lmdb.open(location + name, readonly=True, lock=lock, readahead=readahead,
+                     max_spare_txns=max_spare_txns)
+
+# Read-only environments open in this process, shared by all their readers, e.g. several Turtles
+# on the same store: (absolute path, pid) -> [environment, references].
+_shared_envs = {}
+_shared_envs_lock = threading.Lock()
+
+def acquire_read_lmdb(location, name, readahead=LMDB_READAHEAD, lock=LMDB_LOCK, max_spare_txns=LMDB_SPARE_TXNS):
+    ''' Returns the read-only environment of a database shared by all readers in this process and
+        takes a reference to it, to be released with release_read_lmdb(). LMDB does not allow the
+        same environment to be opened twice in one process. The options of the reader which opened
+        it apply until its last reference is released.
+    '''
+    key = (os.path.abspath(location + name), os.getpid())
+    with _shared_envs_lock:
+        if key not in _shared_envs:
+            _shared_envs[key] = [read_lmdb(location, name, readahead=readahead, lock=lock,
+                                           max_spare_txns=max_spare_txns), 0]
+        _shared_envs[key][1] += 1
+        return _shared_envs[key][0]
+
+def release_read_lmdb(env):
+    ''' Releases a reference taken by acquire_read_lmdb(), closing the environment with the last.
+    '''
+    with _shared_envs_lock:
+        for key, shared in _shared_envs.items():
+            if shared[0] is env:
+                shared[1] -= 1
+                if shared[1] == 0:
+                    del _shared_envs[key]
+                    env.close()
+                return
+
+def is_read_lmdb_open(location, name):
+    ''' Returns whether a reader in this process holds the database open, which prevents opening
+        it for writing.
+    '''
+    with _shared_envs_lock:
+        return (os.path.abspath(location + name), os.getpid()) in _shared_envs
+
+# Read transactions open in this process and in each thread, and whether a thread is forking.
+_reads = threading.Condition()
+_reads_open = 0
+_reads_local = threading.local()
+_forking = False
+
+@contextlib.contextmanager
+def read_txn(env):
+    ''' Begins a read transaction, counted so that a fork waits for the transactions of other threads
+        to end first (see _before_fork). A thread must not fork inside a read of its own.
+    '''
+    global _reads_open
+    own = getattr(_reads_local, 'open', 0)
+    with _reads:
+        # Reads nested in one which is already open must not wait for the fork, which waits for them.
+        while _forking and own == 0:
+            _reads.wait()
+        _reads_open += 1
+    _reads_local.open = own + 1
+    try:
+        with env.begin() as txn:
+            yield txn
+    finally:
+        _reads_local.open = own
+        with _reads:
+            _reads_open -= 1
+            _reads.notify_all()
+
+def _before_fork():
+    # Closing its copies of the environments in the child aborts every transaction inherited from
+    # the parent, and aborting frees the transaction's slot in the lock table, which is shared
+    # with the parent. So no read may be open in another thread at the fork, nor start until the
+    # fork is done. The condition is held through the fork.
+    global _forking
+    _reads.acquire()
+    _forking = True
+    while _reads_open > getattr(_reads_local, 'open', 0):
+        _reads.wait()
+
+def _after_fork_in_parent():
+    global _forking
+    _forking = False
+    _reads.notify_all()
+    _reads.release()
+
+def _after_fork_in_child():
+    # A forked child, e.g. a data loader worker, must not read through its parent's environments,
+    # but must close its copies before opening the same databases again. The locks may have been
+    # held by a parent's thread at the fork.
+    global _shared_envs_lock, _reads, _reads_open, _forking
+    _shared_envs_lock = threading.Lock()
+    _reads = threading.Condition()
+    _reads_open = getattr(_reads_local, 'open', 0)
+    _forking = False
+    for shared in _shared_envs.values():
+        shared[0].close()
+    _shared_envs.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork,
+                        after_in_parent=_after_fork_in_parent,
+                        after_in_child=_after_fork_in_child)
 
 
 ###########################################################################
 #                Option 2: store to HDF5 files                            #
 ###########################################################################
 
-def save_to_hdf5(db_location, patches, coords, file_name, labels):
-    """ Saves the numpy arrays to HDF5 files. All patches from a single WSI will be saved
-        to the same HDF5 file, regardless of the transaction size specified by rows_per_txn,
-        because this is the most efficient way to use HDF5 datasets.
+def new_hdf5(db_location, file_name, patch_size, channels=3):
+    """ Creates the HDF5 file of one WSI with an empty, resizable patch dataset, and an empty
+        csv file for the label meta, so that patches can be appended by save_to_hdf5() as they
+        are sampled. Returns the open HDF5 file; close it with close_hdf5().
+    """
+    file = h5py.File(db_location + file_name + '.h5', 'w')
+    file.create_dataset('t', (0, patch_size, patch_size, channels), h5py.h5t.STD_I32BE,
+                        maxshape=(None, patch_size, patch_size, channels),
+                        chunks=(1, patch_size, patch_size, channels))
+    open(db_location + file_name + '.csv', 'w').close()
+    return file
+
+def save_to_hdf5(db_location, patches, coords, file_name, labels, file=None):
+    """ Saves the numpy arrays to HDF5 files. All patches from a single WSI are saved to the
+        same HDF5 file.
         - db_location       folder to save images in
         - patches           numpy images
         - coords            x, y tile coordinates
         - file_name         original source WSI name
         - labels            patch labels (opt)
+        - file              HDF5 file from new_hdf5() to append the patches to; if None, a new
+                            file is written with all the patches of the WSI in one go
     """
 
     # Save patches into hdf5 file.
-    file    = h5py.File(db_location + file_name + '.h5','w')
-    dataset = file.create_dataset('t', np.shape(patches), h5py.h5t.STD_I32BE, data=patches)
+    if file is None:
+        file    = h5py.File(db_location + file_name + '.h5','w')
+        dataset = file.create_dataset('t', np.shape(patches), h5py.h5t.STD_I32BE, data=patches)
+        mode    = 'w'
+    else:
+        dataset = file['t']
+        offset  = dataset.shape[0]
+        if len(patches) > 0:
+            dataset.resize(offset + len(patches), axis=0)
+            dataset[offset:] = np.asarray(patches)
+        file.flush()
+        mode    = 'a'
 
-    # Save all label meta into a csv file.
-    with open(db_location + file_name + '.csv', 'w', newline='') as csvfile:
+    # Save all label meta into a csv file. Patches without a label get -1, so that their
+    # coords are kept.
+    with open(db_location + file_name + '.csv', mode, newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter=' ',
                             quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        for i in range(len(labels)):
-            writer.writerow([coords[i][0], coords[i][1], labels[i]])
+        for i in range(len(coords)):
+            writer.writerow([coords[i][0], coords[i][1], labels[i] if len(labels) > 0 else -1])
+
+def close_hdf5(file):
+    """ Closes an HDF5 file opened by new_hdf5(). """
+    file.close()
 
 
 ###########################################################################
@@ -120,3 +508,477 @@ def save_to_disk(db_location, patches, coords, file_name, labels):
 
         # Save the image.
         Image.fromarray(patch).save(db_location + patch_fname + ".png")
+
+
+###########################################################################
+#                Option 5: save to memory-mapped numpy arrays             #
+###########################################################################
+
+def new_npy(db_location, file_name, num_patches, patch_size, channels=3):
+    """ Preallocates a uint8 .npy file of shape (num_patches, patch_size, patch_size, channels)
+        for all the patches of one WSI, and returns it as a writable memmap.
+        - num_patches       upper bound on the number of patches; see close_npy()
+    """
+    return np.lib.format.open_memmap(db_location + file_name + '.npy',
+                                     mode='w+',
+                                     dtype=np.uint8,
+                                     shape=(num_patches, patch_size, patch_size, channels))
+
+def save_to_npy(patch_array, offset, patches):
+    """ Writes a batch of patches into the preallocated memmap at the given offset and
+        returns the offset of the next free row.
+    """
+    if len(patches) > 0:
+        patch_array[offset:offset + len(patches)] = np.asarray(patches, dtype=np.uint8)
+        patch_array.flush()
+    return offset + len(patches)
+
+def close_npy(db_location, file_name, patch_shape, coords, labels):
+    """ Finishes the .npy file of one WSI: drops the unused preallocated rows, and saves the
+        coords and labels to a sidecar <file_name>_meta.npy array with rows [x, y, label].
+        Patches without a label get -1. The file is truncated in place, so the caller must flush
+        and drop its memmap from new_npy() first.
+        - patch_shape       shape of one patch, the memmap's shape without its first axis
+    """
+    _truncate_npy(db_location + file_name + '.npy', (len(coords),) + tuple(patch_shape))
+
+    meta = np.full((len(coords), 3), -1, dtype=np.int64)
+    if len(coords) > 0:
+        meta[:, :2] = coords
+    if len(labels) > 0:
+        meta[:, 2] = labels
+    np.save(db_location + file_name + '_meta.npy', meta)
+
+def _truncate_npy(path, shape):
+    """ Shrinks a C-ordered .npy file along its first axis in place. The header is rewritten
+        with the new shape and padded with spaces to its old length, so the data offset is unchanged.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        old_shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f) \
+            if version == (1, 0) else np.lib.format.read_array_header_2_0(f)
+        if old_shape == shape:
+            return
+        data_offset = f.tell()
+        # The header starts after the magic string, version and header length fields.
+        header_start = 10 if version == (1, 0) else 12
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order,
+                       'shape': shape})
+        header = header.ljust(data_offset - header_start - 1) + '\n'
+        f.seek(header_start)
+        f.write(header.encode('latin1'))
+        f.truncate(data_offset + int(np.prod(shape)) * dtype.itemsize)
+
+
+###########################################################################
+#                Option 4: save patches to tar shards                     #
+###########################################################################
+
+def shard_extension(codec):
+    ''' The file extension of the pixel member in a shard, which tells readers how to decode it. '''
+    return 'raw' if codec == 'none' else codec
+
+def shard_key(file_name, x, y):
+    ''' Sample key within a shard. WebDataset readers split the key from the extension at the
+        first dot, so dots in the slide name are replaced. '''
+    return (file_name + '_' + str(x) + '_' + str(y)).replace('.', '_')
+
+def list_shards(db_location, prefix):
+    ''' Returns the paths of all shards with the given prefix, in write order. '''
+    return [db_location + f for f in sorted(os.listdir(db_location))
+            if fnmatch.fnmatch(f, prefix + '-[0-9]*.tar')]
+
+class ShardWriter(object):
+
+    def __init__(self, db_location, prefix, max_bytes=SHARD_MAX_BYTES, codec='none'):
+        """ Writes patches into size-capped, uncompressed tar shards in WebDataset style. Each patch
+            is stored as two consecutive members: <key>.<ext> with the encoded pixels and <key>.json
+            with its meta. Shards are written strictly sequentially and can be streamed, copied and
+            distributed as plain files.
+            - db_location       folder to save shards in
+            - prefix            shard file name prefix; shards are named <prefix>-000000.tar, ...
+            - max_bytes         a new shard is started once a shard would grow beyond this size
+            - codec             codec the pixels are encoded with (see compress.py)
+        """
+        self.db_location = db_location
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.codec = codec
+
+        self.num_shards = 0
+        self.total_bytes = 0
+        self.__tar = None
+        self.__shard_bytes = 0
+
+    def write(self, patches, coords, file_name, labels=[], codec_workers=None):
+        """ Appends a batch of patches from one WSI to the shards.
+            - patches, coords, file_name, labels    as for the other save functions
+            - codec_workers                         number of threads encoding patches
+        """
+        encoded = encode_patches(patches, self.codec, codec_workers)
+        self.write_encoded(encoded, [np.shape(p) for p in patches], coords, file_name, labels)
+
+    def write_encoded(self, encoded, shapes, coords, file_name, labels=[]):
+        """ Appends a batch of patches which are already encoded with the writer's codec.
+            - encoded       encoded pixels of each patch
+            - shapes        shape of each patch
+        """
+        ext = shard_extension(self.codec)
+
+        for i, data in enumerate(encoded):
+            x, y = int(coords[i][0]), int(coords[i][1])
+            meta = {
+                'file': file_name,
+                'coords': [x, y],
+                'label': int(labels[i]) if len(labels) > 0 else -1,
+                'shape': list(shapes[i]),
+                'codec': self.codec,
+            }
+            meta = json.dumps(meta).encode('utf-8')
+
+            # Each member costs a 512 byte header plus padding to the next 512 byte block.
+            sample_bytes = 2 * 512 + _tar_padded(len(data)) + _tar_padded(len(meta))
+            if self.__tar is None or (self.__shard_bytes + sample_bytes > self.max_bytes and self.__shard_bytes > 0):
+                self.__next_shard()
+
+            key = shard_key(file_name, x, y)
+            self.__add_member(key + '.' + ext, data)
+            self.__add_member(key + '.json', meta)
+            self.__shard_bytes += sample_bytes
+            self.total_bytes += sample_bytes
+
+    def close(self):
+        if self.__tar is not None:
+            self.__tar.close()
+            self.__tar = None
+
+    def __next_shard(self):
+        self.close()
+        path = self.db_location + self.prefix + '-' + str(self.num_shards).zfill(6) + '.tar'
+        self.__tar = tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT)
+        self.__shard_bytes = 0
+        self.num_shards += 1
+
+    def __add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.__tar.addfile(info, io.BytesIO(data))
+
+def index_shards(paths):
+    ''' Counts the samples of each WSI in each shard from the tar headers alone, without reading
+        the pixels. Returns {shard key prefix of the WSI: {shard path: number of samples}}, where
+        the key prefix is the WSI name as written by shard_key().
+    '''
+    index = {}
+    for key, samples in locate_shard_samples(paths).items():
+        counts = index.setdefault(key, {})
+        for sample in samples:
+            counts[sample[2]] = counts.get(sample[2], 0) + 1
+    return index
+
+def locate_shard_samples(paths):
+    ''' Finds where every sample is in the shards from the tar headers alone. Returns
+        {shard key prefix of the WSI: [(x, y, path, data offset, data size, meta offset, meta size)]},
+        so that single samples can be read with read_shard_samples().
+    '''
+    locations = {}
+    for path in paths:
+        # Random access mode seeks over the member data.
+        with tarfile.open(path, 'r:') as tar:
+            members = tar.getmembers()
+        # The pixels and the meta of a sample are always written next to each other.
+        for data, meta in zip(members[0::2], members[1::2]):
+            key, x, y = data.name.rsplit('.', 1)[0].rsplit('_', 2)
+            locations.setdefault(key, []).append(
+                (int(x), int(y), path, data.offset_data, data.size, meta.offset_data, meta.size))
+    return locations
+
+def read_shard_samples(path, members):
+    ''' Reads single samples of a shard located by locate_shard_samples(), seeking straight to
+        them. Yields the samples as read_shard() does.
+        - members       (data offset, data size, meta offset, meta size) of each sample
+    '''
+    with open(path, 'rb') as f:
+        for data_offset, data_size, meta_offset, meta_size in members:
+            f.seek(meta_offset)
+            meta = json.loads(f.read(meta_size).decode('utf-8'))
+            f.seek(data_offset)
+            data = f.read(data_size)
+            yield {'patch': decode_patch(data, meta['codec'], meta['shape']),
+                   'coords': meta['coords'],
+                   'label': meta['label'],
+                   'file': meta['file']}
+
+def _tar_padded(size):
+    return (size + 511) // 512 * 512
+
+def read_shard(path, decode=True):
+    ''' Streams the samples of a single shard in storage order. Yields dictionaries with the keys
+        patch, coords, label and file. If decode is False, patch holds the encoded bytes, and the
+        keys codec and shape say how to decode them.
+    '''
+    with tarfile.open(path, 'r|') as tar:
+        data, meta = None, None
+        for member in tar:
+            content = tar.extractfile(member).read()
+            if member.name.endswith('.json'):
+                meta = json.loads(content.decode('utf-8'))
+            else:
+                data = content
+
+            # The pixels and the meta of a sample are always written next to each other.
+            if data is not None and meta is not None:
+                sample = {'patch': data, 'coords': meta['coords'], 'label': meta['label'], 'file': meta['file']}
+                if decode:
+                    sample['patch'] = decode_patch(data, meta['codec'], meta['shape'])
+                else:
+                    sample.update(codec=meta['codec'], shape=tuple(meta['shape']))
+                yield sample
+                data, meta = None, None
+
+def stream_shards(paths, shuffle_buffer=0, workers=4, seed=None, decode=True, queue_size=256):
+    ''' Streams samples from many shards, reading and decoding up to workers shards in parallel.
+        Samples from different shards are interleaved as they arrive. With shuffle_buffer > 0,
+        samples are shuffled within a buffer of that many samples, which trades memory for randomness.
+        - paths             shard paths, e.g. from list_shards()
+        - shuffle_buffer    size of the shuffle buffer; 0 disables shuffling
+        - workers           number of shards read concurrently
+        - seed              seed for the shard order and the shuffle buffer
+        - decode            decode pixels into numpy patches
+        - queue_size        maximum number of decoded samples waiting to be consumed
+    '''
+    rng = random.Random(seed)
+    paths = list(paths)
+    if shuffle_buffer > 0:
+        rng.shuffle(paths)
+
+    samples = queue.Queue(maxsize=queue_size)
+    pending = queue.Queue()
+    for path in paths:
+        pending.put(path)
+    done = object()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                try:
+                    path = pending.get_nowait()
+                except queue.Empty:
+                    break
+                for sample in read_shard(path, decode):
+                    if stop.is_set():
+                        break
+                    samples.put(sample)
+        except Exception as e:
+            samples.put(e)
+        samples.put(done)
+
+    num_workers = max(1, min(workers, len(paths)))
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(num_workers)]
+    for t in threads:
+        t.start()
+
+    buffer = []
+    finished = 0
+    try:
+        while finished < num_workers:
+            sample = samples.get()
+            if sample is done:
+                finished += 1
+                continue
+            if isinstance(sample, Exception):
+                raise sample
+
+            if shuffle_buffer <= 0:
+                yield sample
+            elif len(buffer) < shuffle_buffer:
+                buffer.append(sample)
+            else:
+                # Swap the new sample in for a random buffered one.
+                i = rng.randrange(shuffle_buffer)
+                buffer[i], sample = sample, buffer[i]
+                yield sample
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+    finally:
+        # Unblock and stop the readers if the consumer stops early.
+        stop.set()
+        while any(t.is_alive() for t in threads):
+            try:
+                samples.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+###########################################################################
+#                Store info                                               #
+###########################################################################
+
+def save_store_info(db_location, db_name, info):
+    """ Records how a store was sampled in a JSON file beside it, for every storage type:
+        - coord_units   'tiles' if patch coords are tile grid indices, 'pixels' if they are the top
+                        left pixel coords at the level (random sampling)
+    """
+    with open(db_location + db_name + STORE_INFO_SUFFIX, 'w') as f:
+        json.dump(info, f)
+
+def get_store_info(db_location, db_name):
+    """ Returns the info recorded by save_store_info(). Stores written before it existed were
+        sampled on the tile grid.
+    """
+    info = {'coord_units': 'tiles'}
+    path = db_location + db_name + STORE_INFO_SUFFIX
+    if os.path.exists(path):
+        with open(path) as f:
+            info.update(json.load(f))
+    return info
+
+
+###########################################################################
+#                Merging partial stores                                   #
+###########################################################################
+
+def lmdb_size(location, name):
+    ''' Size in bytes of an LMDB environment's data file. '''
+    return os.path.getsize(os.path.join(location + name, 'data.mdb'))
+
+def merge_lmdb(sources, location, name, meta_name, entries_per_txn=1000):
+    ''' Merges several LMDB patch databases and their meta databases into a new one. Values are
+        copied as raw bytes without unpickling or decoding pixels. Slide ids are reassigned in the
+        merged meta database and the binary keys rewritten accordingly; deduplicated payloads
+        shared between sources are stored once.
+        - sources           list of (location, name, meta_name) of the databases to merge
+        - location, name    the merged patch database
+        - meta_name         the merged meta database
+        - entries_per_txn   number of entries written per transaction
+
+        Returns the number of patches copied.
+    '''
+    # The merged data can be no larger than the sources combined, plus anything already merged.
+    targets = [(location, n) for n in [name, meta_name] if os.path.exists(os.path.join(location + n, 'data.mdb'))]
+    existing = sum(lmdb_size(l, n) for l, n in targets)
+    map_size = (sum(lmdb_size(l, n) for l, n, _ in sources) + existing) * 2 + 2 ** 20
+    meta_map_size = (sum(lmdb_size(l, m) for l, _, m in sources) + existing) * 2 + 2 ** 20
+    env = new_lmdb(location, name, map_size)
+    meta_env = new_lmdb(location, meta_name, meta_map_size)
+
+    codec = None
+    count = 0
+    for source_location, source_name, source_meta_name in sources:
+        source_env = acquire_read_lmdb(source_location, source_name)
+        source_meta_env = acquire_read_lmdb(source_location, source_meta_name)
+
+        source_codec = get_codec_from_lmdb(source_meta_env)
+        if codec is None:
+            codec = source_codec
+            save_codec_in_lmdb(meta_env, codec)
+        elif source_codec != codec:
+            # Items record their own codec, so they still decode correctly.
+            print("[py-wsi]: merging databases with different codecs,", codec, "and", source_codec)
+
+        # Copy the meta, assigning new slide ids.
+        id_map = {}
+        with read_txn(source_meta_env) as source_txn:
+            for key, value in source_txn.cursor():
+                if key in [CODEC_KEY, SLIDE_ID_KEY]:
+                    continue
+                file = key.decode('ascii')
+                dims = pickle.loads(value)
+                if len(dims) > 2:
+                    id_map[dims[2]] = get_slide_id(meta_env, file)
+                    save_meta_in_lmdb(meta_env, file, dims[:2], id_map[dims[2]])
+                else:
+                    save_meta_in_lmdb(meta_env, file, dims)
+
+        # Stream the patches across in key order, in bounded transactions.
+        with read_txn(source_env) as source_txn:
+            # A single iterator; a new iter() over the cursor would repeat its current entry.
+            entries = iter(source_txn.cursor())
+            chunk = list(itertools.islice(entries, entries_per_txn))
+            while len(chunk) > 0:
+                with env.begin(write=True) as txn:
+                    for key, value in chunk:
+                        if key.startswith(PAYLOAD_PREFIX):
+                            txn.put(key, value, overwrite=False)
+                            continue
+                        # Legacy 'file-x-y' keys are copied as they are, even where their length
+                        # matches a binary key; binary keys always hold one of the source's slide ids.
+                        if len(id_map) > 0 and len(key) == KEY_SIZE + len(CORE_PREFIX) and key.startswith(CORE_PREFIX):
+                            slide_id, x, y = parse_lmdb_key(key[len(CORE_PREFIX):])
+                            if slide_id in id_map:
+                                txn.put(core_key(id_map[slide_id], x, y), value)
+                                continue
+                        if len(id_map) > 0 and len(key) == KEY_SIZE:
+                            slide_id, x, y = parse_lmdb_key(key)
+                            if slide_id in id_map:
+                                key = lmdb_key(id_map[slide_id], x, y)
+                        txn.put(key, value)
+                        count += 1
+                chunk = list(itertools.islice(entries, entries_per_txn))
+
+        release_read_lmdb(source_env)
+        release_read_lmdb(source_meta_env)
+
+    env.close()
+    meta_env.close()
+    return count
+
+def merge_files(sources, location, prefix=''):
+    ''' Merges file-based stores (HDF5, disk, npy and shards) by copying their files into one
+        directory. Files are streamed, not decoded. Shards are renumbered to continue the
+        sequence of shards already copied.
+        - sources           list of directories of the partial stores
+        - location          directory of the merged store
+        - prefix            shard prefix, for shard stores
+
+        Returns the number of files copied.
+    '''
+    num_shards = len(list_shards(location, prefix))
+    count = 0
+    for source in sources:
+        shards = set(list_shards(source, prefix))
+        for f in sorted(os.listdir(source)):
+            path = source + f
+            if not os.path.isfile(path):
+                continue
+            if path in shards:
+                target = location + prefix + '-' + str(num_shards).zfill(6) + '.tar'
+                num_shards += 1
+            else:
+                target = location + f
+            shutil.copyfile(path, target)
+            count += 1
+    return count
+
+
+###########################################################################
+#                Converting between storage types                         #
+###########################################################################
+
+# Patches are converted as samples, dictionaries with the keys patch, coords, label and file like
+# those of read_shard(). If patch holds encoded bytes rather than a numpy patch, the keys codec
+# and shape say how to decode them.
+
+def sample_shape(sample):
+    ''' Shape of the patch of a sample. '''
+    if isinstance(sample['patch'], bytes):
+        return tuple(sample['shape'])
+    return np.shape(sample['patch'])
+
+def sample_to_patch(sample):
+    ''' The patch of a sample as a numpy array, decoding it if it is encoded. '''
+    if isinstance(sample['patch'], bytes):
+        return decode_patch(sample['patch'], sample['codec'], sample['shape'])
+    return np.asarray(sample['patch'], dtype=np.uint8)
+
+def sample_to_bytes(sample, codec):
+    ''' The patch of a sample encoded with codec. Pixels already encoded with codec are returned
+        as they are, so converting between stores with the same codec never re-encodes.
+    '''
+    if isinstance(sample['patch'], bytes) and sample['codec'] == codec:
+        return sample['patch']
+    return encode_patch(sample_to_patch(sample), codec)
@@ -0,0 +1,126 @@
+'''
+
+Survey of the geometry of a cohort of whole slide images: level counts, level dimensions, tile
+grids, resolution, and the number of patches sampling would store at each level, to help choose
+a level and patch size for the whole cohort.
+
+Only a few properties are read from each slide; the tile grids for any patch size are computed
+from them the same way as by OpenSlide's DeepZoomGenerator. The properties are cached in a JSON
+file, keyed by each file's size and modification time, so a slide is only opened again if it
+changes.
+
+Author: @ysbecca
+
+'''
+import json
+import math
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .patch_reader import open_slide, DeepZoomGenerator, patch_to_tile_size
+
+
+# OpenSlide property names of the resolution in microns per pixel.
+MPP_PROPERTIES = ['openslide.mpp-x', 'openslide.mpp-y']
+
+
+def file_signature(path):
+    ''' Size and modification time of a file, which change whenever the file does. '''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_slide_properties(path):
+    ''' Opens a slide and reads the properties its geometry is derived from:
+        - signature             see file_signature()
+        - dimensions            level 0 dimensions of the deep zoom pyramid
+        - bounded_dimensions    the same with limit_bounds, i.e. of the non-empty region only
+        - slide_level_count     number of levels stored in the slide file
+        - mpp                   microns per pixel in x and y at level 0, or None if not recorded
+    '''
+    slide = open_slide(path)
+    mpp = [slide.properties.get(p) for p in MPP_PROPERTIES]
+    properties = {
+        'signature': file_signature(path),
+        'dimensions': list(DeepZoomGenerator(slide, limit_bounds=False).level_dimensions[-1]),
+        'bounded_dimensions': list(DeepZoomGenerator(slide, limit_bounds=True).level_dimensions[-1]),
+        'slide_level_count': slide.level_count,
+        'mpp': [float(m) for m in mpp] if None not in mpp else None,
+    }
+    slide.close()
+    return properties
+
+def load_survey_cache(path):
+    ''' Loads the cached slide properties, or returns an empty cache. '''
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print("[py-wsi]: ignoring unreadable survey cache", path)
+        return {}
+
+def save_survey_cache(path, cache):
+    ''' Saves the cache; it is written to a temporary file first so a reader never sees half of it. '''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+def get_slide_properties(paths, cache, workers=4):
+    ''' Returns the properties of each slide path from the cache, reading the slides which are
+        not cached or have changed since in parallel, and adding them to the cache.
+
+        Returns the properties by path, and whether the cache was updated.
+    '''
+    stale = [p for p in paths if p not in cache or cache[p]['signature'] != file_signature(p)]
+    if len(stale) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for path, properties in zip(stale, pool.map(read_slide_properties, stale)):
+                cache[path] = properties
+    return {p: cache[p] for p in paths}, len(stale) > 0
+
+def get_deepzoom_geometry(dimensions, tile_size):
+    ''' Computes the level count, level tiles and level dimensions of a deep zoom pyramid with
+        the given level 0 dimensions, as DeepZoomGenerator does: each level halves the one above,
+        rounding up, down to a single pixel.
+    '''
+    z_size = tuple(dimensions)
+    z_dimensions = [z_size]
+    while z_size[0] > 1 or z_size[1] > 1:
+        z_size = tuple(max(1, int(math.ceil(z / 2))) for z in z_size)
+        z_dimensions.append(z_size)
+    level_dimensions = tuple(reversed(z_dimensions))
+    level_tiles = tuple(tuple(int(math.ceil(z / tile_size)) for z in z_size) for z_size in level_dimensions)
+    return len(level_dimensions), level_tiles, level_dimensions
+
+def count_full_tiles(length, tile_size, overlap):
+    ''' Number of tiles along one axis of a level which have the full patch size. The others, at
+        the edges, are smaller and are not sampled (see get_patch_tile()).
+    '''
+    num_tiles = int(math.ceil(length / tile_size))
+    count = 0
+    for t in range(num_tiles):
+        size = min(tile_size, length - tile_size * t) + overlap * (t != 0) + overlap * (t != num_tiles - 1)
+        if size == tile_size + 2 * overlap:
+            count += 1
+    return count
+
+def get_slide_geometry(properties, patch_size, overlap=0, limit_bounds=True):
+    ''' The geometry of a slide for a patch size, from its properties. Returns a dictionary with
+        level_count, level_tiles and level_dimensions as from DeepZoomGenerator, patch_counts (the
+        number of full-size patches of each level), mpp and slide_level_count.
+    '''
+    tile_size = patch_to_tile_size(patch_size, overlap)
+    dimensions = properties['bounded_dimensions'] if limit_bounds else properties['dimensions']
+    level_count, level_tiles, level_dimensions = get_deepzoom_geometry(dimensions, tile_size)
+    patch_counts = [count_full_tiles(w, tile_size, overlap) * count_full_tiles(h, tile_size, overlap)
+                    for w, h in level_dimensions]
+    return {
+        'level_count': level_count,
+        'level_tiles': level_tiles,
+        'level_dimensions': level_dimensions,
+        'patch_counts': patch_counts,
+        'mpp': properties['mpp'],
+        'slide_level_count': properties['slide_level_count'],
+    }
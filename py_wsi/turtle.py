@@ -7,12 +7,17 @@ Author: @ysbecca
 
 """
 import itertools
+import copy
 import math
+import multiprocessing
+import os
 import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 
-from PIL import Image
 from os import listdir
 from os.path import isfile, join
 
@@ -22,6 +27,9 @@ from .patch_reader import *
 from .store import *
 from .helpers import *
 from .config import *
+from .mosaic import *
+from .survey import *
+from .spatial import *
 
 class Turtle(object):
 
@@ -34,10 +42,10 @@ class Turtle(object):
     			 label_map={},
     			 ):
         """ The py-wsi manager class for manipulating svs and patches. 
-            - storage_type  expecting 'lmdb', 'hdf5', disk'
+            - storage_type  expecting 'lmdb', 'hdf5', 'disk', 'shards', 'npy'
             - file_dir      location of all the image files
             - db_location   path where images will be stored
-            - db_name       name of database (name for LMDB; prefix of files for HDF5 and disk)
+            - db_name       name of database (name for LMDB; prefix of files for HDF5, disk, shards and npy)
             - xml_dir       path of XML annoation files, if used
             - label_map     dictionary of labels and their integer labels expected in annotation files
         """
@@ -63,6 +71,23 @@ class Turtle(object):
         self.xml_dir = xml_dir
         self.label_map = label_map
 
+        # Stain matrices per image, estimated when stain normalisation is used.
+        self.stain_cache = {}
+
+        # Slide properties from the survey cache in db_location, loaded on first use.
+        self.__survey_cache = None
+
+        # Spatial indexes of the stored patch coords of each image, built on the first query.
+        self.__spatial_indexes = {}
+
+        # References to the shared read-only LMDB environments used by this Turtle's reads and
+        # threads (see __read_lmdb), the process which took them, and how they are opened.
+        self.__read_envs = {}
+        self.__read_envs_lock = threading.Lock()
+        self.__read_envs_pid = os.getpid()
+        self.__lmdb_readahead = LMDB_READAHEAD
+        self.__lmdb_lock = LMDB_LOCK
+
         print("======================================================")
         print("Storage type:              ", self.storage_type)
         print("Images directory:          ", self.file_dir)
@@ -101,11 +126,51 @@ class Turtle(object):
         if not self.__check_file_found(file_name):
             return 0, [], []
 
-        # Open image and return variables.
-        slide = open_slide(self.file_dir + file_name)
-        tiles = DeepZoomGenerator(slide, tile_size=tile_dim, overlap=overlap)
+        # Computed from the cached slide properties, so the image is only opened the first time.
+        properties = self.__get_slide_properties([file_name])[file_name]
+        return get_deepzoom_geometry(properties['dimensions'], tile_dim)
 
-        return tiles.level_count, tiles.level_tiles, tiles.level_dimensions
+    def survey_slides(self, patch_size, overlap=0, limit_bounds=True, workers=4):
+        """ Surveys the geometry of every image in the dataset for a patch size, to help choose the
+            level and patch size for the whole cohort, and prints a summary per level. Images are
+            read in parallel, and only if they are not in the survey cache yet (see survey.py).
+            - patch_size        the patch size in pixels
+            - overlap           pixel overlap of patches
+            - limit_bounds      as for sample_and_store_patches()
+            - workers           number of images read concurrently
+
+            Returns a dictionary of the geometry of each image, with the keys level_count, level_tiles
+            and level_dimensions (as from retrieve_tile_dimensions()), patch_counts (the number of
+            full-size patches sampling would store at each level), mpp (microns per pixel at level 0,
+            or None) and slide_level_count.
+        """
+        if overlap < 0:
+            print("[py-wsi error]: negative overlap not allowed.")
+            return None
+        if patch_to_tile_size(patch_size, overlap) <= 0:
+            print("[py-wsi error]: patch size must be larger than twice the overlap.")
+            return None
+
+        properties = self.__get_slide_properties(self.files, workers=workers)
+        survey = {f: get_slide_geometry(properties[f], patch_size, overlap, limit_bounds) for f in self.files}
+        if len(survey) == 0:
+            return survey
+
+        print("================ Cohort Survey ===============")
+        print("Level  Images  Min dimensions   Max dimensions   Total patches")
+        for level in range(max(g['level_count'] for g in survey.values())):
+            geometries = [g for g in survey.values() if level < g['level_count']]
+            dims = [g['level_dimensions'][level] for g in geometries]
+            smallest = min(dims, key=lambda d: d[0] * d[1])
+            largest = max(dims, key=lambda d: d[0] * d[1])
+            print(str(level).ljust(7) + str(len(geometries)).ljust(8)
+                  + (str(smallest[0]) + "x" + str(smallest[1])).ljust(17)
+                  + (str(largest[0]) + "x" + str(largest[1])).ljust(17)
+                  + str(sum(g['patch_counts'][level] for g in geometries)))
+        mpps = sorted(set(tuple(g['mpp']) for g in survey.values() if g['mpp'] is not None))
+        print("Microns per pixel at level 0:", mpps if len(mpps) > 0 else "not recorded")
+        print("")
+        return survey
 
     def retrieve_sample_patch(self, file_name, patch_size, level, overlap=0):
         """ Fetches a sample patch from the centre of a whole slide image for testing.
@@ -134,13 +199,15 @@ class Turtle(object):
         new_tile = tiles.get_tile(level, (int(x / 2), int(y / 2)))
         return new_tile
 
-    def get_set_patches(self, set_id, total_sets, select=[]):
+    def get_set_patches(self, set_id, total_sets, select=[], workers=1, use_processes=False):
         """ Retrieves all the patches from the database given a set id, and the total
             number of sets. The ith set includes all patches from the ith image.
             - set_id            the set id
             - total_sets        the total number of sets to divide the dataset into
             - select            a custom selection array, optional, to specify which images to 
                                 retrieve patches from
+            - workers           number of images to load concurrently; 1 loads them one after another
+            - use_processes     load images in a process pool rather than a thread pool
         """
         if select == []:
             select = np.zeros(self.num_files)
@@ -151,15 +218,29 @@ class Turtle(object):
                 print("[py-wsi error]: select array provided but does not match the number of files,", self.num_files)
                 return []
 
-        # Fetch all the patches from each selected image in dataset.
+        selected_files = [self.files[i] for i in range(self.num_files) if select[i]]
+
+        # Fetch all the patches from each selected image in dataset. Pool.map returns results in
+        # submission order, so the patches are assembled in the same order as a sequential read.
+        if workers > 1 and len(selected_files) > 1:
+            max_workers = min(workers, len(selected_files))
+            if use_processes:
+                # Spawned rather than forked, as forking a process which runs other threads, e.g.
+                # loader threads, is unsafe.
+                pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                pool = ThreadPoolExecutor(max_workers=max_workers)
+            with pool:
+                results = list(pool.map(self.get_patches_from_file, selected_files))
+        else:
+            results = [self.get_patches_from_file(f) for f in selected_files]
+
         all_patches, all_coords, all_cls, all_labels = [], [], [], []
-        for i in range(self.num_files):
-            if select[i]:
-                patches, coords, classes, labels = self.get_patches_from_file(self.files[i])
-                all_patches.append(patches)
-                all_coords.append(coords)
-                all_cls.append(classes)
-                all_labels.append(labels)
+        for patches, coords, classes, labels in results:
+            all_patches.append(patches)
+            all_coords.append(coords)
+            all_cls.append(classes)
+            all_labels.append(labels)
 
         # Flatten the data into lists.
         all_patches = list(itertools.chain.from_iterable(x for x in all_patches))
@@ -179,27 +260,114 @@ class Turtle(object):
             return self.__get_patches_from_disk(file_name[:-4], verbose=verbose)
         elif self.storage_type == 'hdf5':
             return self.__get_patches_from_hdf5(file_name[:-4], verbose=verbose)
+        elif self.storage_type == 'shards':
+            return self.__get_patches_from_shards(file_name[:-4], verbose=verbose)
+        elif self.storage_type == 'npy':
+            return self.__get_patches_from_npy(file_name[:-4], verbose=verbose)
         else:
             # LMDB by default.
             items = self.__get_items_from_file(file_name[:-4])
             return self.__items_to_patches_and_meta(items)
 
+    def query_patches(self, file_name, bbox=None, polygon=None):
+        """ Fetches only the stored patches of one image whose coords are within a bounding box or
+            polygon. A spatial index of the image's patch coords is built from the stored meta on the
+            first query and kept, and then only the matching patches are read, by key or offset.
+            Coords are in the units the patches were stored with: tile indices, or pixel coords at
+            the level for randomly sampled patches.
+            - file_name         the whole slide image the patches were sampled from
+            - bbox              (x_min, y_min, x_max, y_max), bounds included
+            - polygon           list of (x, y) vertices; patches on the boundary are included
+
+            Returns patches, coords, classes and labels as get_patches_from_file() does, in storage order.
+        """
+        if not self.__check_file_found(file_name):
+            return None
+        if (bbox is None) == (polygon is None):
+            print("[py-wsi error]: query with either a bounding box or a polygon.")
+            return None
+
+        index = self.__get_spatial_index(file_name[:-4])
+        if bbox is not None:
+            rows = index.query_bbox(*bbox)
+        else:
+            rows = index.query_polygon(polygon)
+        patches, coords, classes = self.__read_indexed_patches(file_name[:-4], index, rows)
+
+        labels = []
+        if self.label_map != {}:
+            for cl_ in classes:
+                # If there is a class, assign a label.
+                if cl_ != -1:
+                    l = np.zeros((len(self.label_map)))
+                    l[cl_] = 1
+                    labels.append(l)
+        return patches, coords, classes, labels
+
     def sample_and_store_patches(self,
                                  patch_size,
                                  level,
                                  overlap,
                                  load_xml=False,
                                  limit_bounds=True,
-                                 rows_per_txn=20):
+                                 rows_per_txn=None,
+                                 dedup=False,
+                                 codec='none',
+                                 codec_workers=None,
+                                 shard_bytes=SHARD_MAX_BYTES,
+                                 stain_normalise=False,
+                                 roi_only=False,
+                                 num_random=0,
+                                 random_mask='none',
+                                 seed=None,
+                                 node_rank=0,
+                                 num_nodes=1,
+                                 queue_size=2,
+                                 txn_bytes=TXN_BYTES,
+                                 core_tiles=False):
         """ Samples patches from all whole slide images in the dataset and stores them in the
             specified format.
             - patch_size        the patch size in pixels to sample
             - level             the tile level to sample at
             - overlap           pixel overlap of patches
             - limit_bounds      activates OpenSlide's automatic boundary limits (cuts out some background)
-            - rows_per_txn      how many rows in the WSI to sample (save in memory) before saving to disk
-                                a smaller number will use less RAM; a bigger number is slightly more
-                                efficient but will use more RAM.
+            - rows_per_txn      if set, also save to disk after this many rows of the WSI, even if
+                                txn_bytes has not been reached. The memory this uses depends on the width
+                                of the WSI, the patch size and the level; prefer txn_bytes.
+            - dedup             LMDB only; hash patches while writing and store each unique patch once,
+                                e.g. the many identical blank patches at the slide borders.
+            - codec             LMDB and shards only; lossless codec for the stored pixels, one of compress.CODECS.
+                                Compressed databases are smaller but cost CPU to encode and decode.
+            - codec_workers     number of threads encoding patches in parallel; None uses all cores
+            - shard_bytes       shards only; maximum size of each tar shard in bytes
+            - stain_normalise   stain-normalise patches (Macenko) before they are stored, so they need not
+                                be normalised every time they are loaded. The stain matrix of each image
+                                is estimated once from a thumbnail and kept in stain_cache.
+            - roi_only          only sample tiles which intersect the annotated regions (requires load_xml).
+                                For slides with small annotated regions this reads far fewer tiles.
+            - num_random        if > 0, sample this many patches at random locations per image instead of
+                                the whole tile grid. Stored coords are then the top left pixel coords at
+                                the level rather than tile indices.
+            - random_mask       where random locations are drawn from: 'none' (anywhere), 'tissue' (non-white
+                                areas of a thumbnail) or 'annotation' (inside annotated regions; requires load_xml)
+            - seed              seed for the random locations; each image draws the same locations for a
+                                given seed, regardless of the order images are sampled in
+            - node_rank         for sampling on several machines: the rank of this node, from 0
+            - num_nodes         the number of nodes. With more than one node, this node only samples its
+                                share of the images (see get_node_turtle()) into its own partial store in
+                                get_partial_location(node_rank); combine them with merge_partial_stores().
+            - queue_size        blocks of patches which may wait to be written. Blocks are written in a
+                                background thread while the next patches are read, so reading and writing
+                                overlap; a bigger queue smooths out slow commits but holds more patches in RAM.
+            - txn_bytes         bytes of sampled patches to hold in memory before saving them to disk in one
+                                transaction, for every storage type. At most (queue_size + 2) * txn_bytes of
+                                patches are held at once; the peak is printed when sampling finishes.
+            - core_tiles        LMDB and the tile grid only; with overlap, store every pixel once. The core
+                                of each tile, without its overlap border, is stored once, and patches are
+                                assembled from the cores of neighbouring tiles when they are read. At
+                                overlap=64 and patch_size=256 this stores about a quarter of the pixels.
+                                Patches which would not be assembled identical to the tile read from the
+                                slide, e.g. where tiles were resampled, are stored whole.
         """
         start_time = start_timer()
 
@@ -213,25 +381,411 @@ class Turtle(object):
         if overlap < 0:
             print("[py-wsi error]: negative overlap not allowed.")
             return
+        if (roi_only or random_mask == 'annotation') and not load_xml:
+            print("[py-wsi error]: sampling within annotated regions requires load_xml=True.")
+            return
+        if queue_size < 1:
+            print("[py-wsi error]: queue size must be at least 1.")
+            return
+        if txn_bytes <= 0:
+            print("[py-wsi error]: transaction size in bytes must be positive.")
+            return
+        if not 0 <= node_rank < num_nodes:
+            print("[py-wsi error]: node rank", node_rank, "is not within the number of nodes", num_nodes)
+            return
+        if random_mask not in RANDOM_MASKS:
+            print("[py-wsi error]: random mask not recognised; expecting one of", RANDOM_MASKS)
+            return
+        if dedup and self.storage_type != 'lmdb':
+            print("[py-wsi]: deduplication is only supported for LMDB; storing all patches.")
+            dedup = False
+        if not check_codec(codec):
+            return
+        if core_tiles and (self.storage_type != 'lmdb' or num_random > 0):
+            print("[py-wsi error]: core tiles are only supported for LMDB and the tile grid.")
+            return
+        if codec != 'none' and self.storage_type not in ['lmdb', 'shards']:
+            print("[py-wsi]: codecs are only supported for LMDB and shards; storing uncompressed patches.")
+            codec = 'none'
 
         xml_dir = False
         if load_xml:
             xml_dir = self.xml_dir
 
+        # Options passed through to the patch reader for every image.
+        stats = {'peak_buffered_bytes': 0}
+        options = {'queue_size': queue_size, 'txn_bytes': txn_bytes, 'stats': stats}
+        if stain_normalise:
+            options['stain_normalise'] = True
+            options['stain_cache'] = self.stain_cache
+        if roi_only:
+            options['roi_only'] = True
+        if num_random > 0:
+            options.update(num_random=num_random, random_mask=random_mask, seed=seed)
+        if core_tiles:
+            options['core_tiles'] = True
+
+        # The stored patches are about to change.
+        self.__spatial_indexes = {}
+
+        turtle = self
+        if num_nodes > 1:
+            turtle = self.get_node_turtle(node_rank, num_nodes)
+            print("Node", node_rank, "of", num_nodes, "sampling", turtle.num_files, "images into", turtle.db_location)
+
         if self.storage_type == 'hdf5':
-            self.__sample_store_hdf5(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn)
+            turtle.__sample_store_hdf5(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options)
         elif self.storage_type == 'disk':
-            self.__sample_store_disk(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn)
+            turtle.__sample_store_disk(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options)
+        elif self.storage_type == 'npy':
+            turtle.__sample_store_npy(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options)
+        elif self.storage_type == 'shards':
+            turtle.__sample_store_shards(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn,
+                                         codec, codec_workers, shard_bytes, **options)
         else:
             # LMDB by default.
-            self.__sample_store_lmdb(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn)
+            # Sampling reopens the databases for writing.
+            turtle.__close_read_envs()
+            if turtle.__is_read_elsewhere():
+                print("[py-wsi error]: the store is still read by another Turtle; close it before sampling.")
+                return
+            turtle.__sample_store_lmdb(patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, dedup,
+                                       codec, codec_workers, **options)
+
+        # Readers need to know whether coords are tile indices or pixel coords.
+        save_store_info(turtle.db_location, turtle.db_name, {'coord_units': 'pixels' if num_random > 0 else 'tiles'})
+
+        print("Peak buffered patch bytes:", stats['peak_buffered_bytes'])
+        if core_tiles:
+            print("Patches assembled from core tiles:", stats.get('assembled_patches', 0))
+        end_timer(start_time)
+
+    def get_node_turtle(self, node_rank, num_nodes):
+        """ Returns a Turtle for one node's share of the images when sampling on several machines,
+            storing into the node's partial store at get_partial_location(node_rank). Images are
+            assigned round-robin in sorted name order, so every node computes the same assignment
+            without any coordination.
+        """
+        node = copy.copy(self)
+        node.files = np.array(sorted(self.files)[node_rank::num_nodes])
+        node.num_files = len(node.files)
+        node.db_location = self.get_partial_location(node_rank)
+        if not os.path.isdir(node.db_location):
+            os.makedirs(node.db_location)
+        return node
+
+    def get_partial_location(self, node_rank):
+        """ Directory of the partial store written by one node. """
+        return self.db_location + self.db_name + "_part" + str(node_rank) + "/"
+
+    def merge_partial_stores(self, num_nodes):
+        """ Combines the partial stores written by num_nodes nodes into this Turtle's store. LMDB
+            databases are merged entry by entry with new slide ids, and the files of the other storage
+            types are copied; in both cases the data is streamed without decoding any pixels.
+        """
+        sources = [self.get_partial_location(rank) for rank in range(num_nodes)]
+        for source in sources:
+            if not os.path.isdir(source):
+                print("[py-wsi error]: partial store not found:", source)
+                return
 
+        start_time = start_timer()
+        self.__spatial_indexes = {}
+        if self.storage_type == 'lmdb':
+            self.__close_read_envs()
+            if self.__is_read_elsewhere():
+                print("[py-wsi error]: the store is still read by another Turtle; close it before merging.")
+                return
+            count = merge_lmdb([(source, self.db_name, self.db_meta_name) for source in sources],
+                               self.db_location,
+                               self.db_name,
+                               self.db_meta_name)
+            print("Merged", count, "patches from", num_nodes, "partial stores into", self.db_location + self.db_name)
+        else:
+            count = merge_files(sources, self.db_location, prefix=self.db_name)
+            print("Merged", count, "files from", num_nodes, "partial stores into", self.db_location)
+        save_store_info(self.db_location, self.db_name, get_store_info(sources[0], self.db_name))
         end_timer(start_time)
 
+    def convert_store(self,
+                      target_type,
+                      target_location,
+                      target_name=None,
+                      codec=None,
+                      workers=1,
+                      txn_bytes=TXN_BYTES,
+                      shard_bytes=SHARD_MAX_BYTES):
+        """ Copies the stored patches and their meta into a new store of another storage type (or
+            location), without sampling the whole slide images again. The patches of each image are
+            streamed in blocks of txn_bytes, so at most about workers * txn_bytes of patches are held
+            in memory.
+            - target_type       storage type of the new store, one of STORAGE_TYPES
+            - target_location   directory of the new store
+            - target_name       db_name of the new store; defaults to this store's db_name
+            - codec             LMDB and shards only; codec of the new store. None keeps the codec of an
+                                LMDB or shards store. Encoded pixels are copied as they are when the codecs
+                                match, and only re-encoded when they differ.
+            - workers           number of images converted concurrently
+            - txn_bytes         bytes of patches read and written as one block
+            - shard_bytes       shards only; maximum size of each tar shard in bytes
+
+            Returns a Turtle for the new store.
+        """
+        if target_type not in STORAGE_TYPES:
+            print("[py-wsi error]: storage type not recognised; expecting one of", STORAGE_TYPES)
+            return None
+        if target_name is None:
+            target_name = self.db_name
+        if (target_type, target_location, target_name) == (self.storage_type, self.db_location, self.db_name):
+            print("[py-wsi error]: cannot convert a store into itself.")
+            return None
+        if txn_bytes <= 0:
+            print("[py-wsi error]: transaction size in bytes must be positive.")
+            return None
+        if codec is not None and not check_codec(codec):
+            return None
+        if target_type not in ['lmdb', 'shards']:
+            if codec not in [None, 'none']:
+                print("[py-wsi]: codecs are only supported for LMDB and shards; storing uncompressed patches.")
+            codec = 'none'
+        elif codec is None:
+            codec = self.__get_source_codec()
+
+        start_time = start_timer()
+        if not os.path.isdir(target_location):
+            os.makedirs(target_location)
+        target = Turtle(self.file_dir,
+                        target_location,
+                        target_name,
+                        storage_type=target_type,
+                        xml_dir=self.xml_dir,
+                        label_map=self.label_map)
+
+        # Shards are not split by image; find which shards hold each image from the tar headers.
+        shard_index = None
+        if self.storage_type == 'shards':
+            shard_index = index_shards(list_shards(self.db_location, self.db_name))
+        infos = {f: self.__get_source_info(f[:-4], shard_index) for f in self.files}
+
+        env, meta_env, writer = None, None, None
+        if target_type == 'lmdb':
+            # Room for every patch uncompressed plus the item overhead, with a margin.
+            map_size = sum(count * (int(np.prod(shape)) + 1024) * 2 for count, shape in infos.values()) + 2 ** 20
+            env = new_lmdb(target_location, target_name, map_size)
+            meta_env = new_lmdb(target_location, target.db_meta_name, self.num_files * 256 + 2 ** 20)
+            save_codec_in_lmdb(meta_env, codec)
+        elif target_type == 'shards':
+            writer = ShardWriter(target_location, target_name, max_bytes=shard_bytes, codec=codec)
+        writer_lock = threading.Lock()
+
+        def convert(file_name):
+            wsi_name = file_name[:-4]
+            count, shape = infos[file_name]
+            if count == 0:
+                print("[py-wsi]: no stored patches found for", file_name)
+                return 0
+
+            if target_type == 'npy':
+                patch_array = new_npy(target_location + target_name, wsi_name, count, shape[0], shape[2])
+                npy_offset, all_coords, all_labels = 0, [], []
+            elif target_type == 'hdf5':
+                hdf5_file = new_hdf5(target_location, wsi_name, shape[0], shape[2])
+            elif target_type == 'lmdb':
+                slide_id = get_slide_id(meta_env, wsi_name)
+                dims = [0, 0]
+
+            converted = 0
+            try:
+                for block in self.__iter_source_blocks(wsi_name, txn_bytes, shard_index):
+                    coords = [sample['coords'] for sample in block]
+                    labels = [sample['label'] for sample in block]
+                    if all(label == -1 for label in labels):
+                        labels = []
+
+                    if target_type in ['lmdb', 'shards']:
+                        encoded = [sample_to_bytes(sample, codec) for sample in block]
+                        shapes = [sample_shape(sample) for sample in block]
+                        if target_type == 'lmdb':
+                            save_encoded_in_lmdb(env, encoded, shapes, coords, labels, codec=codec, slide_id=slide_id)
+                            dims = [max(dims[0], max(c[0] for c in coords) + 1), max(dims[1], max(c[1] for c in coords) + 1)]
+                        else:
+                            # One sequence of shards is shared by all images.
+                            with writer_lock:
+                                writer.write_encoded(encoded, shapes, coords, wsi_name, labels)
+                    else:
+                        patches = [sample_to_patch(sample) for sample in block]
+                        if target_type == 'disk':
+                            save_to_disk(target_location, patches, coords, wsi_name, labels)
+                        elif target_type == 'hdf5':
+                            save_to_hdf5(target_location, patches, coords, wsi_name, labels, file=hdf5_file)
+                        else:
+                            npy_offset = save_to_npy(patch_array, npy_offset, patches)
+                            all_coords.extend(coords)
+                            all_labels.extend(labels if len(labels) > 0 else [-1] * len(block))
+                    converted += len(block)
+            finally:
+                if target_type == 'hdf5':
+                    close_hdf5(hdf5_file)
+
+            if target_type == 'npy':
+                # Release the memmap before close_npy() truncates its file.
+                patch_shape = patch_array.shape[1:]
+                patch_array.flush()
+                patch_array = None
+                close_npy(target_location + target_name, wsi_name, patch_shape, all_coords, all_labels)
+            elif target_type == 'lmdb':
+                save_meta_in_lmdb(meta_env, wsi_name, dims, slide_id)
+            return converted
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            total_count = sum(pool.map(convert, self.files))
+
+        if env is not None:
+            env.close()
+            meta_env.close()
+        if writer is not None:
+            writer.close()
+        save_store_info(target_location, target_name, get_store_info(self.db_location, self.db_name))
+
+        print("")
+        print("============ Converted Store Stats ===========")
+        print("Total patches converted:                  ", total_count)
+        print("Converted from:                           ", self.storage_type, self.db_location)
+        print("Converted to:                             ", target_type, target_location)
+        print("Patch codec:                              ", codec)
+        print("")
+        end_timer(start_time)
+        return target
+
+    def get_mosaic(self, file_name, scale=8, overlap=0, overlay_labels=False, alpha=0.4):
+        """ Stitches the stored patches of one image back into a downsampled mosaic for quality
+            control. Works with every storage type.
+            - file_name         the whole slide image the patches were sampled from
+            - scale             integer downsampling factor, at most the tile size
+            - overlap           the pixel overlap the patches were sampled with
+            - overlay_labels    overlay each patch's class in colour
+
+            Randomly sampled patches, whose coords are pixel coords, are placed at their coords divided
+            by scale, and overlap is ignored.
+            - alpha             opacity of the class overlay
+
+            Returns the mosaic as a uint8 RGB numpy array.
+        """
+        if not self.__check_file_found(file_name):
+            return None
+        wsi_name = file_name[:-4]
+        # The canvas is sized from the coords alone; the patches are then streamed onto it in blocks.
+        coords = self.__get_spatial_index(wsi_name).coords
+        if len(coords) == 0:
+            print("[py-wsi error]: no stored patches found for", file_name)
+            return None
+
+        pixel_coords = get_store_info(self.db_location, self.db_name)['coord_units'] == 'pixels'
+        patch_size = sample_shape(next(self.__iter_source_samples(wsi_name)))[0]
+        size = patch_size if pixel_coords else patch_to_tile_size(patch_size, overlap)
+        if scaled_size(size, scale) is None:
+            return None
+
+        mosaic = MosaicCanvas(coords, size, overlap=overlap, scale=scale, pixel_coords=pixel_coords, alpha=alpha)
+        for block in self.__iter_source_blocks(wsi_name, MOSAIC_BLOCK_BYTES):
+            mosaic.add([sample_to_patch(sample) for sample in block],
+                       [sample['coords'] for sample in block],
+                       [sample['label'] for sample in block] if overlay_labels else None)
+        return mosaic.canvas
+
+    def save_mosaics(self, out_dir, scale=8, overlap=0, overlay_labels=False, workers=1):
+        """ Saves a mosaic PNG of every image in the dataset to out_dir, building up to workers
+            mosaics concurrently. Parameters as for get_mosaic().
+        """
+        def save(file_name):
+            mosaic = self.get_mosaic(file_name, scale=scale, overlap=overlap, overlay_labels=overlay_labels)
+            if mosaic is not None:
+                Image.fromarray(mosaic).save(out_dir + file_name[:-4] + "_mosaic.png")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(save, self.files))
+
+    def predict_slide(self, file_name, level, patch_size, overlap, fn, batch_size=64, limit_bounds=True,
+                      tissue_only=False, tissue_threshold=220):
+        """ Streaming whole-slide inference: runs fn over batches of every full-size tile of a slide,
+            sampled on the same grid as sample_and_store_patches(), without storing any patches.
+            - file_name         the whole slide image to predict
+            - level             the tile level to sample at
+            - patch_size        the patch size in pixels
+            - overlap           pixel overlap of patches
+            - fn                callable mapping a (B, patch_size, patch_size, 3) uint8 batch to B outputs
+            - batch_size        number of tiles passed to fn at once
+            - limit_bounds      activates OpenSlide's automatic boundary limits
+            - tissue_only       skip tiles without tissue, usually most of a slide; tissue is found in a
+                                thumbnail as the pixels darker than tissue_threshold
+            - tissue_threshold  grey level below which thumbnail pixels are tissue
+
+            Returns a heatmap of shape (y_tiles, x_tiles), or (y_tiles, x_tiles, K) for vector outputs,
+            with NaN where no tile was predicted.
+        """
+        if not self.__check_file_found(file_name):
+            return None
+        if overlap < 0:
+            print("[py-wsi error]: negative overlap not allowed.")
+            return None
+
+        return predict_slide(file_name,
+                             self.file_dir,
+                             overlap,
+                             fn,
+                             patch_size=patch_size,
+                             level=level,
+                             batch_size=batch_size,
+                             limit_bounds=limit_bounds,
+                             tissue_only=tissue_only,
+                             tissue_threshold=tissue_threshold)
+
+    def stream_patches(self, shuffle_buffer=0, workers=4, seed=None):
+        """ Streams all patches from the tar shards of a 'shards' store, reading several shards
+            in parallel. Yields (patch, coords, class, file name) tuples.
+            - shuffle_buffer    shuffle samples within a buffer of this many patches; 0 keeps shard order
+            - workers           number of shards read concurrently
+            - seed              seed for the shard order and shuffle buffer
+        """
+        if self.storage_type != 'shards':
+            print("[py-wsi error]: streaming is only supported for the 'shards' storage type.")
+            return
+
+        for sample in stream_shards(list_shards(self.db_location, self.db_name),
+                                    shuffle_buffer=shuffle_buffer,
+                                    workers=workers,
+                                    seed=seed):
+            yield sample['patch'], sample['coords'], sample['label'], sample['file']
+
     ###########################################################################
     #           General class variable access functions                       #
     ###########################################################################
 
+    def close(self):
+        """ Releases the read-only LMDB environments kept open between reads, which are closed once
+            no other Turtle in the process reads them. A later read reopens them, so this is only
+            needed to release them early, e.g. before another process writes to the database.
+        """
+        self.__close_read_envs()
+
+    def __del__(self):
+        if '_Turtle__read_envs' in self.__dict__:
+            self.__close_read_envs()
+
+    def set_lmdb_readahead(self, readahead):
+        """ Sets whether LMDB reads ahead of the pages read (off by default, see config.py). Turn it
+            on for stores which fit in RAM and are read whole.
+        """
+        self.__close_read_envs()
+        self.__lmdb_readahead = readahead
+
+    def set_lmdb_lock(self, lock):
+        """ Sets whether LMDB reads use the lock table (on by default, see config.py). Turn it off
+            only for stores which are not written while they are read.
+        """
+        self.__close_read_envs()
+        self.__lmdb_lock = lock
+
     def set_label_map(self, label_map):
         self.label_map = label_map
 
@@ -248,9 +802,13 @@ class Turtle(object):
         return self.__get_files_from_dir(self.xml_dir, '.xml')
 
     def set_db_location(self, db_location):
+        self.__close_read_envs()
+        self.__spatial_indexes = {}
         self.db_location = db_location
 
     def set_db_name(self, db_name):
+        self.__close_read_envs()
+        self.__spatial_indexes = {}
         self.db_name = db_name
         self.db_meta_name = self.__get_db_meta_name(db_name)
 
@@ -267,6 +825,33 @@ class Turtle(object):
     def __get_db_meta_name(self, db_name):
         return db_name + "_meta"
 
+    def __getstate__(self):
+        # Environments and locks cannot be pickled, e.g. for a process pool; workers reopen them.
+        state = self.__dict__.copy()
+        state['_Turtle__read_envs'] = {}
+        del state['_Turtle__read_envs_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__read_envs_lock = threading.Lock()
+        self.__read_envs_pid = os.getpid()
+
+    def __get_slide_properties(self, files, workers=4):
+        """ Returns the properties of each file (see survey.py) from the survey cache, reading
+            only the images which are not cached or have changed. The cache is saved in db_location.
+        """
+        cache_path = self.db_location + SURVEY_CACHE_NAME
+        if self.__survey_cache is None:
+            self.__survey_cache = load_survey_cache(cache_path)
+
+        # Keyed by absolute path, so Turtles over different image directories can share a cache.
+        paths = [os.path.abspath(self.file_dir + f) for f in files]
+        properties, updated = get_slide_properties(paths, self.__survey_cache, workers=workers)
+        if updated and os.path.isdir(self.db_location):
+            save_survey_cache(cache_path, self.__survey_cache)
+        return {f: properties[p] for f, p in zip(files, paths)}
+
     def __check_file_found(self, file_name):
         """ Checks if a file is found in the file list.
         """
@@ -314,8 +899,8 @@ class Turtle(object):
         return patches, coords, classes, labels
 
 
-    def __sample_store_hdf5(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn):
-        """ Same parameters as sample_and_store_patches().
+    def __sample_store_hdf5(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options):
+        """ Same parameters as sample_and_store_patches(); options are passed on to the patch reader.
         """
         total_count = 0
         for file in self.files:
@@ -332,7 +917,8 @@ class Turtle(object):
                                 rows_per_txn=rows_per_txn,
                                 db_location=self.db_location,
                                 prefix=self.db_name,
-                                storage_option='hdf5')
+                                storage_option='hdf5',
+                                **options)
 
             # Don't stop if one image fails.
             if patch_count <= 0:
@@ -377,8 +963,69 @@ class Turtle(object):
         return patches, coords, classes, labels
 
 
-    def __sample_store_disk(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn):
-        """ Same parameters as sample_and_store_patches().
+    def __sample_store_disk(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options):
+        """ Same parameters as sample_and_store_patches(); options are passed on to the patch reader.
+        """
+        total_count = 0
+        for file in self.files:
+            print(file, end=" ")
+            patch_count = sample_and_store_patches(
+                                file,
+                                self.file_dir,
+                                overlap,
+                                patch_size=patch_size,
+                                level=level,
+                                xml_dir=xml_dir,
+                                label_map=self.label_map,
+                                limit_bounds=limit_bounds,
+                                rows_per_txn=rows_per_txn,
+                                db_location=self.db_location,
+                                prefix=self.db_name,
+                                storage_option='disk',
+                                **options)
+
+            # Don't stop if one image fails.
+            if patch_count <= 0:
+                print("[py-wsi error]: no patches sampled from ", file, ". Continuing.")
+            total_count += patch_count
+
+        print("")
+        print("============ Patches Dataset Stats ===========")
+        print("Total patches sampled:                    ", total_count)
+        print("Patches saved to:                         ", self.db_location)
+        print("Patches saved with prefix:                ", self.db_name)
+        print("")
+
+
+    ###########################################################################
+    #                Numpy memmap-specific helper functions                   #
+    ###########################################################################
+
+    def __get_patches_from_npy(self, wsi_name, verbose=False):
+        """ Opens the patches of one WSI as a read-only memmap, so no pixels are read until they
+            are accessed. Returns the memmap in place of a list of patches.
+        """
+        path = self.db_location + self.db_name + wsi_name
+        patches = np.load(path + '.npy', mmap_mode='r')
+        meta = np.load(path + '_meta.npy')
+
+        coords = meta[:, :2].tolist()
+        classes = meta[:, 2].tolist()
+        labels = []
+        for cl_ in classes:
+            # If there is a class, assign a label.
+            if cl_ != -1:
+                l = np.zeros((len(self.label_map)))
+                l[cl_] = 1
+                labels.append(l)
+
+        if verbose:
+            print("[py-wsi] opened", wsi_name, ".npy file", np.shape(patches))
+
+        return patches, coords, classes, labels
+
+    def __sample_store_npy(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, **options):
+        """ Same parameters as sample_and_store_patches(); options are passed on to the patch reader.
         """
         total_count = 0
         for file in self.files:
@@ -395,7 +1042,8 @@ class Turtle(object):
                                 rows_per_txn=rows_per_txn,
                                 db_location=self.db_location,
                                 prefix=self.db_name,
-                                storage_option='disk')
+                                storage_option='npy',
+                                **options)
 
             # Don't stop if one image fails.
             if patch_count <= 0:
@@ -410,22 +1058,132 @@ class Turtle(object):
         print("")
 
 
+    ###########################################################################
+    #                Shard-specific helper functions                          #
+    ###########################################################################
+
+    def __get_patches_from_shards(self, wsi_name, verbose=False):
+        """ Loads the patches of one WSI from the shards, seeking to its samples as located from the
+            tar headers (see __get_spatial_index); use stream_patches() for training.
+        """
+        patches, coords, classes, labels = [], [], [], []
+        locators = self.__get_spatial_index(wsi_name).locators
+        for path, members in itertools.groupby(locators, key=lambda locator: locator[0]):
+            for sample in read_shard_samples(path, [member[1:] for member in members]):
+                # Shard keys do not tell apart WSI names differing only in '.' and '_'.
+                if sample['file'] != wsi_name:
+                    continue
+                patches.append(sample['patch'])
+                coords.append(sample['coords'])
+                classes.append(sample['label'])
+                if sample['label'] != -1:
+                    l = np.zeros((len(self.label_map)))
+                    l[sample['label']] = 1
+                    labels.append(l)
+
+        if verbose:
+            print("[py-wsi] loaded", len(patches), "patches from", wsi_name)
+
+        return patches, coords, classes, labels
+
+    def __sample_store_shards(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn,
+                              codec, codec_workers, shard_bytes, **options):
+        """ Same parameters as sample_and_store_patches(); options are passed on to the patch reader.
+            All WSIs are written into one sequence of shards, so a shard may hold patches from
+            consecutive WSIs.
+        """
+        writer = ShardWriter(self.db_location, self.db_name, max_bytes=shard_bytes, codec=codec)
+
+        total_count = 0
+        for file in self.files:
+            print(file, end=" ")
+            patch_count = sample_and_store_patches(
+                                file,
+                                self.file_dir,
+                                overlap,
+                                patch_size=patch_size,
+                                level=level,
+                                xml_dir=xml_dir,
+                                label_map=self.label_map,
+                                limit_bounds=limit_bounds,
+                                rows_per_txn=rows_per_txn,
+                                storage_option='shards',
+                                codec_workers=codec_workers,
+                                shard_writer=writer,
+                                **options)
+
+            # Don't stop if one image fails.
+            if patch_count <= 0:
+                print("[py-wsi error]: no patches sampled from ", file, ". Continuing.")
+            total_count += patch_count
+        writer.close()
+
+        print("")
+        print("============ Patches Dataset Stats ===========")
+        print("Total patches sampled:                    ", total_count)
+        print("Shards written:                           ", writer.num_shards)
+        print("Total shard bytes:                        ", writer.total_bytes)
+        print("Shards saved to:                          ", self.db_location)
+        print("Shards saved with prefix:                 ", self.db_name)
+        print("")
+
+
     ###########################################################################
     #                LMDB-specific helper functions                           #
     ###########################################################################
 
+    def __read_lmdb(self, name):
+        """ Returns a read-only environment for a database in db_location, acquired once and used
+            by all later reads. LMDB does not allow the same environment to be opened twice in one
+            process, so concurrent loader threads and other Turtles on the same store share it (see
+            acquire_read_lmdb). A forked child, e.g. a data loader worker, opens its own on first use.
+        """
+        self.__forget_parent_read_envs()
+        with self.__read_envs_lock:
+            if name not in self.__read_envs:
+                self.__read_envs[name] = acquire_read_lmdb(self.db_location, name, readahead=self.__lmdb_readahead,
+                                                           lock=self.__lmdb_lock)
+            return self.__read_envs[name]
+
+    def __close_read_envs(self):
+        self.__forget_parent_read_envs()
+        with self.__read_envs_lock:
+            for env in self.__read_envs.values():
+                release_read_lmdb(env)
+            self.__read_envs = {}
+
+    def __is_read_elsewhere(self):
+        # Whether another Turtle in the process holds the store open, so it cannot be written.
+        return any(is_read_lmdb_open(self.db_location, name) for name in [self.db_name, self.db_meta_name])
+
+    def __forget_parent_read_envs(self):
+        # A forked child drops its parent's references; store.py closes the environments themselves.
+        # The lock may have been held by a parent's thread.
+        if self.__read_envs_pid != os.getpid():
+            self.__read_envs = {}
+            self.__read_envs_lock = threading.Lock()
+            self.__read_envs_pid = os.getpid()
+
     def __get_items_from_file(self, file_name):
-        # Get the tile dimensions of the image first from meta database.
-        meta_env = read_lmdb(self.db_location, self.db_meta_name)
-        x, y = get_meta_from_lmdb(meta_env, file_name)
-
-        # Loop through all the tiles and fetch all the items.
-        items = []
-        env = read_lmdb(self.db_location, self.db_name)
-        with env.begin() as txn:
-            for y_ in range(y - 1):
-                for x_ in range(x - 1):
-                    items.append(get_patch_from_lmdb(txn, x_, y_, file_name))
+        # Get the tile dimensions and slide id of the image first from meta database.
+        meta_env = self.__read_lmdb(self.db_meta_name)
+        dims = get_meta_from_lmdb(meta_env, file_name)
+
+        env = self.__read_lmdb(self.db_name)
+        with read_txn(env) as txn:
+            if len(dims) > 2:
+                # All items of the slide in one sequential cursor scan.
+                return get_slide_items_from_lmdb(txn, dims[2])
+
+            # Legacy 'file-x-y' keys do not sort by coords, so loop through all the tiles.
+            x, y = dims
+            items = []
+            for y_ in range(y):
+                for x_ in range(x):
+                    item = get_patch_from_lmdb(txn, x_, y_, file_name)
+                    # Edge patches which were too small were never stored.
+                    if item is not None:
+                        items.append(item)
         return items
 
     def __items_to_patches_and_meta(self, items):
@@ -443,37 +1201,44 @@ class Turtle(object):
             labels = []
         return patches, coords, classes, labels
 
-    def __calculate_map_size(self, patch_size, level, overlap, limit_bounds):
-        """ Pre-calculates the LMDB map size for a database given the files.
+    def __calculate_map_size(self, patch_size, level, overlap, limit_bounds, num_random=0):
+        """ Pre-calculates the LMDB map size for a database given the files, for num_random patches
+            per file if sampling at random, or for the whole tile grid.
         """
         total_bytes = 0
         total_meta_bytes = 0
 
+        # The tile grids are computed from the cached slide properties, without opening the images.
+        properties = self.__get_slide_properties(self.files)
         for file in self.files:
-            slide = open_slide(self.file_dir + file)
-            tile_size = patch_to_tile_size(patch_size, overlap)
-            tiles = DeepZoomGenerator(slide, tile_size=tile_size, overlap=overlap, limit_bounds=limit_bounds)
+            geometry = get_slide_geometry(properties[file], patch_size, overlap, limit_bounds)
 
             # Count total number of tiles.
-            x_tiles, y_tiles = tiles.level_tiles[level]
+            x_tiles, y_tiles = geometry['level_tiles'][level]
             file_tiles = x_tiles * y_tiles
+            if num_random > 0:
+                file_tiles = num_random
 
             # Calculate total patch bytes, assuming colour (3 channels), bytes per int plus buffer.
             # If image is saved in float or double, this may be too conservative.
             total_bytes += (file_tiles * patch_size * patch_size * 3 * (sys.getsizeof(int()) + 4))
             total_meta_bytes += file_tiles * 256
 
-        return total_bytes, total_meta_bytes
+        # However few patches, LMDB needs room for the pages of its own trees.
+        return total_bytes, total_meta_bytes + 2 ** 20
 
-    def __sample_store_lmdb(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn):
+    def __sample_store_lmdb(self, patch_size, level, overlap, xml_dir, limit_bounds, rows_per_txn, dedup,
+                            codec, codec_workers, **options):
         """ Samples patches and saves them in LMDB. Parameters from sample_and_store_patches():
-            - patch_size, level, overlap, limit_bounds, rows_per_txn.
+            - patch_size, level, overlap, limit_bounds, rows_per_txn, dedup, codec, codec_workers.
+            - options are passed on to the patch reader.
         """
 
         # First iteration to calculate exactly the size of the DB.
         # To deal with very large databases, it is suggested to save k databases, one for each 
         # k-fold cross validation set.
-        map_size, meta_map_size = self.__calculate_map_size(patch_size, level, overlap, limit_bounds)
+        map_size, meta_map_size = self.__calculate_map_size(patch_size, level, overlap, limit_bounds,
+                                                            options.get('num_random', 0))
         print("Pre-calculated map sizes:")
         print(" - patch db:    ", map_size, "bytes")
         print(" - meta db:     ", meta_map_size, "bytes")
@@ -482,7 +1247,9 @@ class Turtle(object):
         print("Creating new LMDB environment...")
         env = new_lmdb(self.db_location, self.db_name, map_size)
         meta_env = new_lmdb(self.db_location, self.db_meta_name, meta_map_size)
+        save_codec_in_lmdb(meta_env, codec)
 
+        total_count = 0
         for file in self.files:
             print(file, end=" ")
             # Open, sample, and store in multiple transactions per file.
@@ -497,14 +1264,276 @@ class Turtle(object):
                                 xml_dir=xml_dir,
                                 label_map=self.label_map,
                                 limit_bounds=limit_bounds,
-                                rows_per_txn=rows_per_txn)
+                                rows_per_txn=rows_per_txn,
+                                dedup=dedup,
+                                codec=codec,
+                                codec_workers=codec_workers,
+                                **options)
 
             # Don't stop if one image fails.
             if patch_count <= 0:
                 print("[py-wsi error]: no patches sampled from ", file, ". Continuing.")
+            total_count += patch_count
 
         print("")
         print("====== LMDB " + self.db_name + " Stats ======")
         print(env.stat())
         print("====== LMDB " + self.db_meta_name + " Stats ======")
         print(meta_env.stat())
+
+        # Compare what the patches occupy in the database against their raw pixel size.
+        stat = env.stat()
+        stored_bytes = stat['psize'] * (stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'])
+        raw_bytes = total_count * patch_size * patch_size * 3
+        print("====== Patch codec: " + codec + " ======")
+        print("Raw patch bytes:                          ", raw_bytes)
+        print("Stored bytes:                             ", stored_bytes)
+        if stored_bytes > 0:
+            print("Compression ratio:                        ", round(raw_bytes / stored_bytes, 2))
+
+
+    ###########################################################################
+    #                Spatial index helper functions                           #
+    ###########################################################################
+
+    def __get_spatial_index(self, wsi_name):
+        """ Returns the spatial index of the stored patches of one WSI, building it on first use.
+        """
+        if wsi_name not in self.__spatial_indexes:
+            if self.storage_type == 'shards':
+                # One pass over the tar headers locates the samples of every WSI.
+                locations = locate_shard_samples(list_shards(self.db_location, self.db_name))
+                for name in set([f[:-4] for f in self.files] + [wsi_name]):
+                    samples = locations.get(name.replace('.', '_'), [])
+                    self.__spatial_indexes[name] = GridIndex([s[:2] for s in samples], [s[2:] for s in samples])
+            else:
+                coords, locators = self.__get_patch_locations(wsi_name)
+                self.__spatial_indexes[wsi_name] = GridIndex(coords, locators)
+        return self.__spatial_indexes[wsi_name]
+
+    def __get_patch_locations(self, wsi_name):
+        """ Returns the coords of the stored patches of one WSI and where each is stored, reading
+            only the meta: the slide id for LMDB, (row, class) for HDF5 and npy, and (file name,
+            class) for disk.
+        """
+        coords, locators = [], []
+        if self.storage_type == 'lmdb':
+            meta_env = self.__read_lmdb(self.db_meta_name)
+            with read_txn(meta_env) as txn:
+                if txn.get(wsi_name.encode('ascii')) is None:
+                    return coords, locators
+            dims = get_meta_from_lmdb(meta_env, wsi_name)
+            with read_txn(self.__read_lmdb(self.db_name)) as txn:
+                if len(dims) > 2:
+                    for key in iter_slide_keys_in_lmdb(txn, dims[2]):
+                        _, x, y = parse_lmdb_key(key)
+                        coords.append((x, y))
+                        locators.append(dims[2])
+                else:
+                    # Legacy keys; edge patches which were too small were never stored.
+                    cursor = txn.cursor()
+                    for y in range(dims[1]):
+                        for x in range(dims[0]):
+                            if cursor.set_key(legacy_lmdb_key(wsi_name, x, y)):
+                                coords.append((x, y))
+                                locators.append(None)
+
+        elif self.storage_type == 'hdf5':
+            path = self.db_location + wsi_name
+            if not os.path.exists(path + '.csv'):
+                return coords, locators
+            with open(path + '.csv', newline='') as metafile:
+                reader = csv.reader(metafile, delimiter=' ', quotechar='|')
+                for row, meta in enumerate(reader):
+                    coords.append((int(meta[0]), int(meta[1])))
+                    locators.append((row, int(meta[2])))
+
+        elif self.storage_type == 'npy':
+            path = self.db_location + self.db_name + wsi_name + '_meta.npy'
+            if not os.path.exists(path):
+                return coords, locators
+            meta = np.load(path)
+            coords = meta[:, :2].tolist()
+            locators = [(row, cl_) for row, cl_ in enumerate(meta[:, 2].tolist())]
+
+        elif self.storage_type == 'disk':
+            for f, parts in self.__get_disk_patch_files(wsi_name):
+                coords.append((int(parts[1]), int(parts[2])))
+                locators.append((f, int(parts[3]) if parts[3] != '' else -1))
+
+        return coords, locators
+
+    def __read_indexed_patches(self, wsi_name, index, rows):
+        """ Reads the patches at the given rows of a spatial index. Returns patches, coords and classes.
+        """
+        coords = index.coords[rows].tolist()
+        locators = [index.locators[i] for i in rows]
+        if len(rows) == 0:
+            return [], [], []
+
+        if self.storage_type == 'lmdb':
+            with read_txn(self.__read_lmdb(self.db_name)) as txn:
+                items = [get_patch_from_lmdb(txn, x, y, wsi_name, slide_id) for (x, y), slide_id in zip(coords, locators)]
+            return [i.get_patch() for i in items], coords, [i.label for i in items]
+
+        classes = [locator[-1] for locator in locators]
+        if self.storage_type == 'hdf5':
+            with h5py.File(self.db_location + wsi_name + '.h5', 'r') as file:
+                # Rows are in increasing order, as h5py requires.
+                patches = list(np.array(file['t'][[row for row, _ in locators]]).astype('uint8'))
+        elif self.storage_type == 'npy':
+            patch_array = np.load(self.db_location + self.db_name + wsi_name + '.npy', mmap_mode='r')
+            patches = list(patch_array[[row for row, _ in locators]])
+        elif self.storage_type == 'disk':
+            patches = [np.array(Image.open(self.db_location + f), dtype=np.uint8) for f, _ in locators]
+        else:
+            # Shards: seek to each sample, opening each shard once.
+            patches, classes = [], []
+            for path, members in itertools.groupby(locators, key=lambda locator: locator[0]):
+                for sample in read_shard_samples(path, [member[1:] for member in members]):
+                    patches.append(sample['patch'])
+                    classes.append(sample['label'])
+        return patches, coords, classes
+
+
+    ###########################################################################
+    #                Conversion helper functions                              #
+    ###########################################################################
+
+    def __get_source_codec(self):
+        """ Codec of the stored patches; 'none' for storage types without codecs.
+        """
+        if self.storage_type == 'lmdb':
+            return get_codec_from_lmdb(self.__read_lmdb(self.db_meta_name))
+        if self.storage_type == 'shards':
+            for path in list_shards(self.db_location, self.db_name):
+                for sample in read_shard(path, decode=False):
+                    return sample['codec']
+        return 'none'
+
+    def __get_disk_patch_files(self, wsi_name):
+        """ Returns (file name, [wsi name, x, y, label]) of the PNG patches of one WSI.
+        """
+        patch_files = []
+        for f in sorted(listdir(self.db_location)):
+            # Patch files are named <wsi name>_<x>_<y>_<label>.png, with an empty label if unlabelled.
+            parts = f[:-4].rsplit('_', 3)
+            if f.endswith('.png') and len(parts) == 4 and parts[0] == wsi_name:
+                patch_files.append((f, parts))
+        return patch_files
+
+    def __get_source_info(self, wsi_name, shard_index=None):
+        """ Returns the number of stored patches of one WSI and the shape of its patches, reading
+            as little of the store as possible. Returns 0, None if there are none.
+        """
+        count = 0
+        if self.storage_type == 'lmdb':
+            meta_env = self.__read_lmdb(self.db_meta_name)
+            with read_txn(meta_env) as txn:
+                if txn.get(wsi_name.encode('ascii')) is None:
+                    return 0, None
+            dims = get_meta_from_lmdb(meta_env, wsi_name)
+            if len(dims) > 2:
+                with read_txn(self.__read_lmdb(self.db_name)) as txn:
+                    count = count_slide_items_in_lmdb(txn, dims[2])
+            else:
+                count = sum(1 for _ in self.__iter_source_samples(wsi_name))
+        elif self.storage_type == 'hdf5':
+            path = self.db_location + wsi_name
+            if not os.path.exists(path + '.h5'):
+                return 0, None
+            with h5py.File(path + '.h5', 'r') as file:
+                count = file['t'].shape[0]
+            with open(path + '.csv', newline='') as metafile:
+                num_rows = sum(1 for _ in metafile)
+            if num_rows != count:
+                # Stores written before coords were kept for unlabelled patches.
+                print("[py-wsi error]: the coords of", count, "patches are not all stored in", path + '.csv')
+                return 0, None
+        elif self.storage_type == 'disk':
+            count = len(self.__get_disk_patch_files(wsi_name))
+        elif self.storage_type == 'npy':
+            path = self.db_location + self.db_name + wsi_name + '.npy'
+            if not os.path.exists(path):
+                return 0, None
+            count = np.load(path, mmap_mode='r').shape[0]
+        elif self.storage_type == 'shards':
+            count = sum(shard_index.get(wsi_name.replace('.', '_'), {}).values())
+
+        if count == 0:
+            return 0, None
+        first = next(self.__iter_source_samples(wsi_name, shard_index))
+        return count, sample_shape(first)
+
+    def __iter_source_samples(self, wsi_name, shard_index=None):
+        """ Streams the stored patches of one WSI as samples (see store.py), one at a time. Pixels
+            of LMDB and shards stores are left encoded.
+        """
+        if self.storage_type == 'lmdb':
+            dims = get_meta_from_lmdb(self.__read_lmdb(self.db_meta_name), wsi_name)
+            with read_txn(self.__read_lmdb(self.db_name)) as txn:
+                if len(dims) > 2:
+                    items = iter_slide_items_from_lmdb(txn, dims[2])
+                else:
+                    items = (get_patch_from_lmdb(txn, x, y, wsi_name) for y in range(dims[1]) for x in range(dims[0]))
+                for item in items:
+                    if item is None:
+                        continue
+                    yield {'patch': item.data,
+                           'codec': getattr(item, 'codec', 'none'),
+                           'shape': item.get_shape(),
+                           'coords': [int(c) for c in item.coords],
+                           # Unlabelled patches are stored with label 0 in LMDB.
+                           'label': item.label if self.label_map != {} else -1,
+                           'file': wsi_name}
+
+        elif self.storage_type == 'hdf5':
+            path = self.db_location + wsi_name
+            with open(path + '.csv', newline='') as metafile:
+                rows = list(csv.reader(metafile, delimiter=' ', quotechar='|'))
+            with h5py.File(path + '.h5', 'r') as file:
+                dataset = file['t']
+                # Read a few patches at a time rather than the whole dataset.
+                for start in range(0, dataset.shape[0], 64):
+                    patches = np.array(dataset[start:start + 64]).astype('uint8')
+                    for i, patch in enumerate(patches):
+                        row = rows[start + i]
+                        yield {'patch': patch, 'coords': [int(row[0]), int(row[1])], 'label': int(row[2]), 'file': wsi_name}
+
+        elif self.storage_type == 'disk':
+            for f, parts in self.__get_disk_patch_files(wsi_name):
+                yield {'patch': np.array(Image.open(self.db_location + f), dtype=np.uint8),
+                       'coords': [int(parts[1]), int(parts[2])],
+                       'label': int(parts[3]) if parts[3] != '' else -1,
+                       'file': wsi_name}
+
+        elif self.storage_type == 'npy':
+            path = self.db_location + self.db_name + wsi_name
+            patches = np.load(path + '.npy', mmap_mode='r')
+            meta = np.load(path + '_meta.npy')
+            for i in range(len(patches)):
+                yield {'patch': patches[i], 'coords': meta[i, :2].tolist(), 'label': int(meta[i, 2]), 'file': wsi_name}
+
+        elif self.storage_type == 'shards':
+            if shard_index is not None:
+                paths = sorted(shard_index.get(wsi_name.replace('.', '_'), {}))
+            else:
+                # The shards holding the WSI's samples, as located for its spatial index.
+                paths = sorted(set(locator[0] for locator in self.__get_spatial_index(wsi_name).locators))
+            for path in paths:
+                for sample in read_shard(path, decode=False):
+                    if sample['file'] == wsi_name:
+                        yield sample
+
+    def __iter_source_blocks(self, wsi_name, max_bytes, shard_index=None):
+        """ Groups the samples of one WSI into blocks of about max_bytes of patches.
+        """
+        block, block_bytes = [], 0
+        for sample in self.__iter_source_samples(wsi_name, shard_index):
+            block.append(sample)
+            block_bytes += int(np.prod(sample_shape(sample)))
+            if block_bytes >= max_bytes:
+                yield block
+                block, block_bytes = [], 0
+        if len(block) > 0:
+            yield block